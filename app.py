@@ -3,12 +3,9 @@ import os
 from routes.routes_scanner import scanner_bp
 from routes.routes_api_scanner import api_scanner_bp
 import datetime
-import json
 from routes.routes_push import push_bp
-import threading
-import redis
-import push_db
-import push_utils
+import archive_watcher
+import push_worker
 
 app = Flask(__name__)
 app.register_blueprint(scanner_bp)
@@ -76,26 +73,11 @@ def datetimeformat(value, format="%b %d, %I:%M %p"):
     return value.strftime(format)
 
 if __name__ == "__main__":
-    # start push queue worker in background
-    def push_worker():
-        REDIS_URL = os.environ.get('REDIS_URL', 'redis://127.0.0.1:6379/0')
-        r = redis.from_url(REDIS_URL)
-        vapid_pub, vapid_priv = push_utils.load_vapid_keys()
-        vapid_claims = {'sub': 'mailto:admin@iamcalledned.ai'}
-        while True:
-            item = r.brpop('push_queue', timeout=5)
-            if not item:
-                continue
-            _, payload = item
-            try:
-                job = json.loads(payload)
-                subs = push_db.list_subscriptions()
-                for s in subs:
-                    push_utils.send_push(s, {'message': job.get('message')}, vapid_priv, vapid_claims)
-            except Exception as e:
-                print('push_worker error', e)
-
-    push_db.ensure_db()
-    t = threading.Thread(target=push_worker, daemon=True)
-    t.start()
+    # run a push worker in-process for development; in production run
+    # push_worker.py as its own service and set PUSH_WORKER_INLINE=0
+    if os.environ.get('PUSH_WORKER_INLINE', '1') != '0':
+        push_worker.start_worker_thread()
+    # keep the call index current as recordings land (run archive_watcher.py
+    # standalone instead when serving through a multi-process WSGI server)
+    archive_watcher.start_watcher()
     app.run(host="0.0.0.0", port=5005, debug=True)
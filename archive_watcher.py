@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""Keep the call index current as the recorder writes into the archive.
+
+Uses inotify (through libc, no extra dependency) to pick up creates, writes,
+renames and deletes in the feed directories and re-indexes only the calls they
+touch. Where inotify is unavailable it falls back to polling the directories.
+While the watcher is checking in, web readers skip their own directory checks
+and just query the index.
+
+Usage:
+    python3 archive_watcher.py            # run in the foreground
+or call start_watcher() from the app process.
+"""
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+import time
+
+import call_index
+import transcode_cache
+
+POLL_INTERVAL = float(os.environ.get('ARCHIVE_POLL_INTERVAL', '1.0'))
+# Collect bursts of events (wav + json + txt land together) before indexing,
+# but never hold a change back for longer than MAX_DELAY.
+DEBOUNCE = 0.2
+MAX_DELAY = 0.8
+HEARTBEAT_INTERVAL = 2.0
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+EVENT_HEADER = struct.Struct('iIII')
+WATCHED_SUFFIXES = ('.wav', '.json', '.txt')
+
+
+def _load_inotify():
+    libc_name = ctypes.util.find_library('c')
+    if not libc_name:
+        return None
+    libc = ctypes.CDLL(libc_name, use_errno=True)
+    if not hasattr(libc, 'inotify_init1'):
+        return None
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    return libc
+
+
+class ArchiveWatcher:
+    def __init__(self, feeds=call_index.ALL_FEEDS, poll_interval=POLL_INTERVAL):
+        self.feeds = feeds
+        self.poll_interval = poll_interval
+        self.listeners = []
+        self.mode = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add_listener(self, fn):
+        """Register fn(changes) to be called with the (feed, stem) pairs that
+        were re-indexed after each batch of filesystem events or each
+        directory resync."""
+        self.listeners.append(fn)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name='archive-watcher', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def run(self):
+        # Catch up on anything that arrived while nobody was watching.
+        for feed in self.feeds:
+            call_index.sync_feed(feed)
+        call_index.mark_watcher_alive()
+        libc = _load_inotify()
+        if libc is not None:
+            try:
+                self._run_inotify(libc)
+                return
+            except OSError as e:
+                print('archive_watcher: inotify unavailable, polling instead:', e)
+        self._run_polling()
+
+    def _notify(self, changes):
+        for fn in self.listeners:
+            try:
+                fn(changes)
+            except Exception as e:
+                print('archive_watcher listener error', e)
+
+    def _run_inotify(self, libc):
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        watches = {}
+        try:
+            for feed in self.feeds:
+                path = call_index.feed_dir(feed)
+                if not path.is_dir():
+                    print('archive_watcher: skipping missing directory', path)
+                    continue
+                wd = libc.inotify_add_watch(fd, str(path).encode(), WATCH_MASK)
+                if wd < 0:
+                    raise OSError(ctypes.get_errno(), f'inotify_add_watch failed for {path}')
+                watches[wd] = feed
+            self.mode = 'inotify'
+            print('archive_watcher: watching', ', '.join(str(call_index.feed_dir(f)) for f in watches.values()))
+
+            pending = set()
+            overflow = False
+            first_event = None
+            last_beat = time.time()
+            while not self._stop.is_set():
+                timeout = DEBOUNCE if pending or overflow else HEARTBEAT_INTERVAL
+                ready, _, _ = select.select([fd], [], [], timeout)
+                if ready:
+                    overflow |= self._read_events(fd, watches, pending)
+                    if first_event is None and (pending or overflow):
+                        first_event = time.time()
+                if (pending or overflow) and (not ready or time.time() - first_event >= MAX_DELAY):
+                    if overflow:
+                        # The kernel dropped events; fall back to a full diff.
+                        changes = []
+                        for feed in self.feeds:
+                            changes += call_index.sync_feed(feed)[0]
+                        if changes:
+                            self._notify(changes)
+                    else:
+                        changes = list(pending)
+                        call_index.index_calls(changes)
+                        self._notify(changes)
+                    pending.clear()
+                    overflow = False
+                    first_event = None
+                if time.time() - last_beat >= HEARTBEAT_INTERVAL:
+                    call_index.mark_watcher_alive()
+                    last_beat = time.time()
+        finally:
+            os.close(fd)
+
+    def _read_events(self, fd, watches, pending):
+        overflow = False
+        try:
+            buf = os.read(fd, 64 * 1024)
+        except BlockingIOError:
+            return False
+        offset = 0
+        while offset < len(buf):
+            wd, mask, _cookie, length = EVENT_HEADER.unpack_from(buf, offset)
+            offset += EVENT_HEADER.size
+            name = buf[offset:offset + length].rstrip(b'\0').decode(errors='replace')
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                overflow = True
+                continue
+            feed = watches.get(wd)
+            stem, ext = os.path.splitext(name)
+            if feed and ext in WATCHED_SUFFIXES:
+                pending.add((feed, stem))
+        return overflow
+
+    def _run_polling(self):
+        self.mode = 'poll'
+        while not self._stop.is_set():
+            changes = []
+            for feed in self.feeds:
+                changes += call_index.sync_feed(feed)[0]
+            call_index.mark_watcher_alive()
+            if changes:
+                self._notify(changes)
+            self._stop.wait(self.poll_interval)
+
+
+_watcher = None
+_watcher_lock = threading.Lock()
+
+
+def start_watcher():
+    """Start the process-wide watcher once and return it."""
+    global _watcher
+    with _watcher_lock:
+        if _watcher is None:
+            _watcher = ArchiveWatcher()
+            if transcode_cache.PRETRANSCODE_FORMATS and transcode_cache.available():
+                _watcher.add_listener(transcode_cache.pretranscode)
+            _watcher.start()
+        return _watcher
+
+
+if __name__ == '__main__':
+    watcher = ArchiveWatcher()
+    if transcode_cache.PRETRANSCODE_FORMATS and transcode_cache.available():
+        watcher.add_listener(transcode_cache.pretranscode)
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,133 @@
+import datetime
+import mimetypes
+import uuid
+from pathlib import Path
+
+from flask import Response, request, send_file
+from werkzeug.http import is_resource_modified
+
+import call_index
+import transcode_cache
+
+# Recordings never change once written, so clients may keep them for a year
+# and revalidate with the ETag after that.
+AUDIO_MAX_AGE = 365 * 24 * 3600
+CHUNK_SIZE = 64 * 1024
+
+
+def find_audio(filename, feeds=call_index.FEEDS):
+    """Resolve a recording's filename to its path through the call index's
+    filename lookup, preferring feeds in the order given. On a miss the feeds
+    are refreshed once, in case the file landed after the last sync."""
+    feed = call_index.find_feed(filename, feeds)
+    if feed is None:
+        for f in feeds:
+            call_index.refresh(f)
+        feed = call_index.find_feed(filename, feeds)
+    if feed is None:
+        return None
+    return call_index.feed_dir(feed) / filename
+
+
+def send_call_audio(path):
+    """send_audio for a recording, honouring ?format=opus|mp3 by serving the
+    cached compressed variant. Falls back to the WAV if ffmpeg is missing or
+    encoding fails."""
+    fmt = request.args.get("format")
+    if fmt and fmt != "wav":
+        if fmt not in transcode_cache.FORMATS:
+            return Response(f"Unsupported format {fmt}", status=400)
+        if not transcode_cache.available():
+            return send_audio(path)
+        try:
+            variant = transcode_cache.get_variant(path, fmt)
+            # validators come from the source recording, which the variant
+            # was encoded from, so they hold across cache hits and re-encodes
+            src = Path(path).stat()
+            return send_audio(variant, mimetype=transcode_cache.mimetype(fmt),
+                              etag=f"{_etag(src)}-{fmt}", mtime=src.st_mtime)
+        except transcode_cache.TranscodeError as e:
+            print('transcode failed, serving wav', Path(path).name, fmt, e)
+    return send_audio(path)
+
+
+def _etag(st):
+    return f"{st.st_mtime_ns:x}-{st.st_size:x}"
+
+
+def send_audio(path, max_age=AUDIO_MAX_AGE, mimetype=None, etag=None, mtime=None):
+    """Serve an audio file with a strong ETag, Last-Modified, 304 handling,
+    single and multiple byte ranges, and long-lived caching. The ETag and
+    modification time default to the file's own."""
+    path = Path(path)
+    mimetype = mimetype or _mimetype(path)
+    st = path.stat()
+    etag = etag or _etag(st)
+    mtime = st.st_mtime if mtime is None else mtime
+    ranges = request.range.ranges if request.range is not None else []
+    if len(ranges) > 1 and _if_range_matches(etag, mtime):
+        rv = _multirange_response(path, st.st_size, mtime, ranges, etag, mimetype)
+    else:
+        # Flask handles 304s and a single range itself.
+        rv = send_file(path, mimetype=mimetype, etag=etag,
+                       last_modified=mtime, max_age=max_age)
+    if max_age:
+        rv.cache_control.public = True
+        rv.cache_control.max_age = max_age
+        rv.cache_control.immutable = True
+    return rv
+
+
+def _mimetype(path):
+    return mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+
+
+def _if_range_matches(etag, mtime):
+    if_range = request.if_range
+    if if_range.etag is not None:
+        return if_range.etag == etag
+    if if_range.date is not None:
+        return int(mtime) <= if_range.date.timestamp()
+    return True
+
+
+def _multirange_response(path, size, mtime, ranges, etag, mimetype):
+    spans = []
+    for start, stop in ranges:
+        stop = size if stop is None else min(stop, size)
+        if start < size and start < stop:
+            spans.append((start, stop))
+    last_modified = datetime.datetime.fromtimestamp(int(mtime), datetime.timezone.utc)
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        rv = Response(status=304)
+    elif not spans:
+        rv = Response(status=416, headers={"Content-Range": f"bytes */{size}"})
+    else:
+        boundary = uuid.uuid4().hex
+        heads = [(f"\r\n--{boundary}\r\nContent-Type: {mimetype}\r\n"
+                  f"Content-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n").encode()
+                 for start, stop in spans]
+        tail = f"\r\n--{boundary}--\r\n".encode()
+        length = sum(len(h) for h in heads) + sum(stop - start for start, stop in spans) + len(tail)
+
+        def body():
+            with open(path, "rb") as f:
+                for head, (start, stop) in zip(heads, spans):
+                    yield head
+                    f.seek(start)
+                    remaining = stop - start
+                    while remaining > 0:
+                        chunk = f.read(min(CHUNK_SIZE, remaining))
+                        if not chunk:
+                            return
+                        remaining -= len(chunk)
+                        yield chunk
+            yield tail
+
+        rv = Response(body(), status=206, mimetype=f"multipart/byteranges; boundary={boundary}",
+                      direct_passthrough=True)
+        rv.content_length = length
+    rv.set_etag(etag)
+    rv.last_modified = last_modified
+    rv.accept_ranges = "bytes"
+    return rv
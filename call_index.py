@@ -0,0 +1,577 @@
+import sqlite3
+import os
+import json
+import datetime
+import threading
+import time
+from pathlib import Path
+
+import meta_cache
+import review_db
+import sqlite_db
+
+# Persistent index of archived calls: one row per recording so listings can be
+# answered with indexed queries instead of globbing and parsing the archive on
+# every request. The index is derived data and can always be rebuilt from the
+# directory tree (see scripts/rebuild_call_index.py).
+DB_PATH = os.environ.get('CALL_INDEX_DB', os.path.join(os.path.dirname(__file__), 'call_index.sqlite3'))
+ARCHIVE_DIR = Path("/home/ned/scanner_archive/clean")
+FEEDS = ("pd", "fd")
+# Speaker segments awaiting labels are indexed alongside the call feeds.
+SEGMENT_FEED = "segments"
+SEGMENT_DIR = Path("/home/ned/scanner_archive/segmentation/processed")
+FEED_DIRS = {feed: ARCHIVE_DIR / feed for feed in FEEDS}
+FEED_DIRS[SEGMENT_FEED] = SEGMENT_DIR
+ALL_FEEDS = FEEDS + (SEGMENT_FEED,)
+
+# Readers skip their own directory checks while a watcher has checked in
+# within this many seconds (see archive_watcher.py).
+WATCHER_STALE_AFTER = 5
+
+# Bump when the schema changes; the index is dropped and re-synced on mismatch.
+SCHEMA_VERSION = 8
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS calls (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    feed TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    stem TEXT NOT NULL,
+    day TEXT NOT NULL,
+    hour INTEGER,
+    has_json INTEGER NOT NULL DEFAULT 0,
+    transcript TEXT,
+    edited_transcript TEXT,
+    enhanced_transcript TEXT,
+    txt_transcript TEXT,
+    edited INTEGER NOT NULL DEFAULT 0,
+    edit_pending INTEGER NOT NULL DEFAULT 0,
+    metadata TEXT,
+    json_mtime_ns INTEGER,
+    json_size INTEGER,
+    mtime_ns INTEGER NOT NULL DEFAULT 0,
+    seq INTEGER,
+    UNIQUE (feed, filename)
+);
+CREATE INDEX IF NOT EXISTS calls_feed_stem ON calls (feed, stem);
+CREATE INDEX IF NOT EXISTS calls_feed_day_stem ON calls (feed, day, stem);
+CREATE INDEX IF NOT EXISTS calls_filename ON calls (filename);
+-- Publication order for the live stream: a call gets the next seq the first
+-- time it is indexed with its sidecar JSON, and keeps it across re-indexing.
+CREATE UNIQUE INDEX IF NOT EXISTS calls_seq ON calls (seq);
+CREATE TRIGGER IF NOT EXISTS calls_seq_insert AFTER INSERT ON calls
+WHEN new.has_json = 1 BEGIN
+    UPDATE calls SET seq = (SELECT IFNULL(MAX(seq), 0) + 1 FROM calls) WHERE id = new.id;
+END;
+CREATE TRIGGER IF NOT EXISTS calls_seq_update AFTER UPDATE OF has_json ON calls
+WHEN new.has_json = 1 AND new.seq IS NULL BEGIN
+    UPDATE calls SET seq = (SELECT IFNULL(MAX(seq), 0) + 1 FROM calls) WHERE id = new.id;
+END;
+-- Calls per feed and day, kept in step with `calls` by triggers so archive
+-- listings never have to count rows.
+CREATE TABLE IF NOT EXISTS day_counts (
+    feed TEXT NOT NULL,
+    day TEXT NOT NULL,
+    count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (feed, day)
+) WITHOUT ROWID;
+CREATE TRIGGER IF NOT EXISTS calls_day_insert AFTER INSERT ON calls BEGIN
+    INSERT INTO day_counts (feed, day, count) VALUES (new.feed, new.day, 1)
+        ON CONFLICT (feed, day) DO UPDATE SET count = count + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS calls_day_delete AFTER DELETE ON calls BEGIN
+    UPDATE day_counts SET count = count - 1 WHERE feed = old.feed AND day = old.day;
+    DELETE FROM day_counts WHERE feed = old.feed AND day = old.day AND count <= 0;
+END;
+CREATE TRIGGER IF NOT EXISTS calls_day_update AFTER UPDATE OF day ON calls
+WHEN old.day IS NOT new.day BEGIN
+    UPDATE day_counts SET count = count - 1 WHERE feed = old.feed AND day = old.day;
+    DELETE FROM day_counts WHERE feed = old.feed AND day = old.day AND count <= 0;
+    INSERT INTO day_counts (feed, day, count) VALUES (new.feed, new.day, 1)
+        ON CONFLICT (feed, day) DO UPDATE SET count = count + 1;
+END;
+-- Calls per feed, day and hour of day for the heatmap, maintained the same way.
+CREATE TABLE IF NOT EXISTS hour_counts (
+    feed TEXT NOT NULL,
+    day TEXT NOT NULL,
+    hour INTEGER NOT NULL,
+    count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (feed, day, hour)
+) WITHOUT ROWID;
+CREATE TRIGGER IF NOT EXISTS calls_hour_insert AFTER INSERT ON calls
+WHEN new.hour IS NOT NULL BEGIN
+    INSERT INTO hour_counts (feed, day, hour, count) VALUES (new.feed, new.day, new.hour, 1)
+        ON CONFLICT (feed, day, hour) DO UPDATE SET count = count + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS calls_hour_delete AFTER DELETE ON calls
+WHEN old.hour IS NOT NULL BEGIN
+    UPDATE hour_counts SET count = count - 1 WHERE feed = old.feed AND day = old.day AND hour = old.hour;
+    DELETE FROM hour_counts WHERE feed = old.feed AND day = old.day AND hour = old.hour AND count <= 0;
+END;
+CREATE TRIGGER IF NOT EXISTS calls_hour_update AFTER UPDATE OF day, hour ON calls
+WHEN old.day IS NOT new.day OR old.hour IS NOT new.hour BEGIN
+    UPDATE hour_counts SET count = count - 1 WHERE feed = old.feed AND day = old.day AND hour = old.hour;
+    DELETE FROM hour_counts WHERE feed = old.feed AND day = old.day AND hour = old.hour AND count <= 0;
+    INSERT INTO hour_counts (feed, day, hour, count)
+        SELECT new.feed, new.day, new.hour, 1 WHERE new.hour IS NOT NULL
+        ON CONFLICT (feed, day, hour) DO UPDATE SET count = count + 1;
+END;
+-- Full-text index over the transcript variants. External content: the text
+-- lives in `calls` and the triggers below mirror every change into it.
+CREATE VIRTUAL TABLE IF NOT EXISTS calls_fts USING fts5(
+    transcript, edited_transcript, enhanced_transcript,
+    content='calls', content_rowid='id', tokenize='porter unicode61'
+);
+CREATE TRIGGER IF NOT EXISTS calls_fts_insert AFTER INSERT ON calls BEGIN
+    INSERT INTO calls_fts (rowid, transcript, edited_transcript, enhanced_transcript)
+        VALUES (new.id, new.transcript, new.edited_transcript, new.enhanced_transcript);
+END;
+CREATE TRIGGER IF NOT EXISTS calls_fts_delete AFTER DELETE ON calls BEGIN
+    INSERT INTO calls_fts (calls_fts, rowid, transcript, edited_transcript, enhanced_transcript)
+        VALUES ('delete', old.id, old.transcript, old.edited_transcript, old.enhanced_transcript);
+END;
+CREATE TRIGGER IF NOT EXISTS calls_fts_update AFTER UPDATE OF transcript, edited_transcript, enhanced_transcript ON calls
+WHEN old.transcript IS NOT new.transcript OR old.edited_transcript IS NOT new.edited_transcript
+    OR old.enhanced_transcript IS NOT new.enhanced_transcript BEGIN
+    INSERT INTO calls_fts (calls_fts, rowid, transcript, edited_transcript, enhanced_transcript)
+        VALUES ('delete', old.id, old.transcript, old.edited_transcript, old.enhanced_transcript);
+    INSERT INTO calls_fts (rowid, transcript, edited_transcript, enhanced_transcript)
+        VALUES (new.id, new.transcript, new.edited_transcript, new.enhanced_transcript);
+END;
+CREATE TABLE IF NOT EXISTS index_state (
+    key TEXT PRIMARY KEY,
+    value REAL NOT NULL
+);
+'''
+
+UPSERT_SQL = '''
+INSERT INTO calls (feed, filename, stem, day, hour, has_json, transcript, edited_transcript,
+                   enhanced_transcript, txt_transcript, edited, edit_pending, metadata,
+                   json_mtime_ns, json_size, mtime_ns)
+VALUES (:feed, :filename, :stem, :day, :hour, :has_json, :transcript, :edited_transcript,
+        :enhanced_transcript, :txt_transcript, :edited, :edit_pending, :metadata,
+        :json_mtime_ns, :json_size, :mtime_ns)
+ON CONFLICT (feed, filename) DO UPDATE SET
+    stem = excluded.stem,
+    day = excluded.day,
+    hour = excluded.hour,
+    has_json = excluded.has_json,
+    transcript = excluded.transcript,
+    edited_transcript = excluded.edited_transcript,
+    enhanced_transcript = excluded.enhanced_transcript,
+    txt_transcript = excluded.txt_transcript,
+    edited = excluded.edited,
+    edit_pending = excluded.edit_pending,
+    metadata = excluded.metadata,
+    json_mtime_ns = excluded.json_mtime_ns,
+    json_size = excluded.json_size,
+    mtime_ns = excluded.mtime_ns
+'''
+
+# feed -> directory mtime_ns seen at the last sync in this process
+_dir_mtimes = {}
+_sync_lock = threading.Lock()
+
+
+def get_conn():
+    """Return this thread's connection to the index, creating it on first use."""
+    return _db.conn()
+
+
+def _ensure_schema(conn):
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    if version != SCHEMA_VERSION:
+        # Derived data only: drop and let the next sync repopulate it.
+        # (Virtual tables come before their shadow tables and drop them.)
+        for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'").fetchall():
+            conn.execute(f'DROP TABLE IF EXISTS "{name}"')
+        _dir_mtimes.clear()
+    conn.executescript(SCHEMA)
+    conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+    conn.commit()
+
+
+_db = sqlite_db.ThreadLocalDB(lambda: DB_PATH, _ensure_schema, row_factory=sqlite3.Row)
+
+
+def feed_dir(feed):
+    return FEED_DIRS.get(feed, ARCHIVE_DIR / feed)
+
+
+def call_day(stem):
+    try:
+        date_str = stem.split("_")[1]
+        return datetime.datetime.strptime(date_str, "%Y-%m-%d").date().strftime("%Y-%m-%d")
+    except Exception:
+        return "unknown"
+
+
+def call_hour(stem):
+    """Hour of day the recording started, or None if the name has no time."""
+    try:
+        return datetime.datetime.strptime(stem.replace("rec_", ""), "%Y-%m-%d_%H-%M-%S").hour
+    except Exception:
+        return None
+
+
+def _read_text(path):
+    try:
+        return path.read_text()
+    except OSError:
+        return None
+
+
+def build_row(directory, feed, stem, mtime_ns=None):
+    """Read one call's sidecar files and return its index row, or None if the
+    recording itself is gone."""
+    directory = Path(directory)
+    wav = directory / f"{stem}.wav"
+    json_path = wav.with_suffix(".json")
+    txt = wav.with_suffix(".txt")
+    if mtime_ns is None:
+        mtimes = []
+        for p in (wav, json_path, txt):
+            try:
+                mtimes.append(p.stat().st_mtime_ns)
+            except OSError:
+                if p is wav:
+                    return None
+        mtime_ns = max(mtimes)
+
+    row = {
+        "feed": feed,
+        "filename": wav.name,
+        "stem": stem,
+        "day": call_day(stem),
+        "hour": call_hour(stem),
+        "has_json": 0,
+        "transcript": None,
+        "edited_transcript": None,
+        "enhanced_transcript": None,
+        "txt_transcript": _read_text(txt),
+        "edited": 0,
+        # review_db holds the edit queue; the sidecar only changes once an
+        # edit is approved and applied
+        "edit_pending": int(review_db.has_pending(feed, wav.name)),
+        "metadata": None,
+        "json_mtime_ns": None,
+        "json_size": None,
+        "mtime_ns": mtime_ns,
+    }
+    if json_path.exists():
+        try:
+            sig = meta_cache.signature(json_path)
+            data = meta_cache.load_json(json_path, sig)
+            edited = bool(data.get("edited") and data.get("edited_transcript"))
+            row.update({
+                "has_json": 1,
+                "transcript": data.get("transcript"),
+                "edited_transcript": data.get("edited_transcript"),
+                "enhanced_transcript": data.get("enhanced_transcript"),
+                "edited": int(edited),
+                "metadata": json.dumps(data),
+                "json_mtime_ns": sig[0],
+                "json_size": sig[1],
+            })
+        except Exception as e:
+            print(f"[!] Failed to index JSON for {stem}: {e}")
+    return row
+
+
+def _bump_generation(conn):
+    conn.execute("INSERT INTO index_state (key, value) VALUES ('generation', 1) "
+                 "ON CONFLICT (key) DO UPDATE SET value = value + 1")
+
+
+def get_generation():
+    """Counter bumped by every write to the index; unchanged means no new data."""
+    row = get_conn().execute("SELECT value FROM index_state WHERE key = 'generation'").fetchone()
+    return int(row[0]) if row else 0
+
+
+def mark_watcher_alive():
+    conn = get_conn()
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO index_state (key, value) VALUES ('watcher_seen', ?)", (time.time(),))
+
+
+def watcher_alive():
+    row = get_conn().execute("SELECT value FROM index_state WHERE key = 'watcher_seen'").fetchone()
+    return bool(row) and time.time() - row[0] < WATCHER_STALE_AFTER
+
+
+def index_calls(items):
+    """Upsert (or drop, if the recording was removed) the given (feed, stem)
+    pairs in one transaction. Returns the number of calls touched."""
+    upserts, deletes = [], []
+    for feed, stem in set(items):
+        row = build_row(feed_dir(feed), feed, stem)
+        if row is None:
+            deletes.append((feed, f"{stem}.wav"))
+        else:
+            upserts.append(row)
+    if not upserts and not deletes:
+        return 0
+    conn = get_conn()
+    with conn:
+        if upserts:
+            conn.executemany(UPSERT_SQL, upserts)
+        if deletes:
+            conn.executemany('DELETE FROM calls WHERE feed = ? AND filename = ?', deletes)
+        _bump_generation(conn)
+    return len(upserts) + len(deletes)
+
+
+def index_call(feed, stem):
+    return index_calls([(feed, stem)])
+
+
+def refresh_edit_pending(calls):
+    """Re-read the review queue state of the given (feed, filename) calls,
+    after an edit is submitted or decided."""
+    flags = [(int(review_db.has_pending(feed, filename)), feed, filename) for feed, filename in set(calls)]
+    if not flags:
+        return
+    conn = get_conn()
+    with conn:
+        conn.executemany('UPDATE calls SET edit_pending = ? WHERE feed = ? AND filename = ?', flags)
+        _bump_generation(conn)
+
+
+def sync_feed(feed, directory=None, force=False):
+    """Bring one feed's rows in line with its directory.
+
+    Only stats files; sidecars are re-read just for calls that are new or whose
+    mtime changed since they were indexed (every call when ``force``). Changes
+    are committed in one transaction. Returns (upserted, deleted): the
+    (feed, stem) pairs of the calls (re-)indexed and the number of rows
+    dropped.
+    """
+    directory = Path(directory or feed_dir(feed))
+    files = {}
+    try:
+        with os.scandir(directory) as it:
+            for entry in it:
+                stem, ext = os.path.splitext(entry.name)
+                if ext not in (".wav", ".json", ".txt"):
+                    continue
+                try:
+                    files.setdefault(stem, {})[ext] = entry.stat().st_mtime_ns
+                except OSError:
+                    continue
+    except FileNotFoundError:
+        pass
+
+    conn = get_conn()
+    known = dict(conn.execute('SELECT filename, mtime_ns FROM calls WHERE feed = ?', (feed,)).fetchall())
+    rows = []
+    for stem, mtimes in files.items():
+        if ".wav" not in mtimes:
+            continue
+        mtime_ns = max(mtimes.values())
+        if known.pop(f"{stem}.wav", None) == mtime_ns and not force:
+            continue
+        row = build_row(directory, feed, stem, mtime_ns)
+        if row is not None:
+            rows.append(row)
+    if rows or known:
+        with conn:
+            if rows:
+                conn.executemany(UPSERT_SQL, rows)
+            if known:
+                conn.executemany('DELETE FROM calls WHERE feed = ? AND filename = ?', [(feed, f) for f in known])
+            _bump_generation(conn)
+    return [(feed, row["stem"]) for row in rows], len(known)
+
+
+def refresh(feed, directory=None):
+    """Re-sync a feed if its directory changed since this process last looked.
+
+    Directory mtime moves on every create, rename and delete, so between new
+    recordings this is a single stat() call. While an archive watcher is
+    running the index is already current and this does nothing.
+    """
+    directory = Path(directory or feed_dir(feed))
+    if watcher_alive():
+        return
+    try:
+        mtime_ns = directory.stat().st_mtime_ns
+    except FileNotFoundError:
+        return
+    if _dir_mtimes.get(feed) == mtime_ns:
+        return
+    with _sync_lock:
+        if _dir_mtimes.get(feed) == mtime_ns:
+            return
+        sync_feed(feed, directory)
+        _dir_mtimes[feed] = mtime_ns
+
+
+def rebuild(feeds=ALL_FEEDS):
+    """Re-read every call of the given feeds from disk and drop stale rows."""
+    totals = {}
+    with _sync_lock:
+        for feed in feeds:
+            _dir_mtimes.pop(feed, None)
+            totals[feed] = len(sync_feed(feed, force=True)[0])
+    return totals
+
+
+def query_calls(feed, day=None, limit=None, offset=0, require_json=False, columns="*"):
+    """Return index rows for a feed, newest first."""
+    sql = f'SELECT {columns} FROM calls WHERE feed = ?'
+    params = [feed]
+    if day is not None:
+        sql += ' AND day = ?'
+        params.append(day)
+    if require_json:
+        sql += ' AND has_json = 1'
+    sql += ' ORDER BY stem DESC'
+    if limit is not None:
+        sql += ' LIMIT ? OFFSET ?'
+        params.extend([int(limit), int(offset)])
+    return get_conn().execute(sql, params).fetchall()
+
+
+def day_counts(feed):
+    """Return [(day, count)] for a feed, newest day first."""
+    return get_conn().execute('SELECT day, count FROM day_counts WHERE feed = ? ORDER BY day DESC',
+                              (feed,)).fetchall()
+
+
+def day_count(feed, day):
+    row = get_conn().execute('SELECT count FROM day_counts WHERE feed = ? AND day = ?', (feed, day)).fetchone()
+    return row[0] if row else 0
+
+
+def max_seq():
+    row = get_conn().execute('SELECT MAX(seq) FROM calls').fetchone()
+    return row[0] or 0
+
+
+def calls_since(seq, feeds, limit=None):
+    """Calls of the given feeds published after ``seq``, oldest first. With
+    ``limit``, only the newest ``limit`` of them. Calls whose sidecar
+    couldn't be read are left out, as in the live listings."""
+    sql = (f'SELECT * FROM calls WHERE seq > ? AND feed IN ({", ".join("?" * len(feeds))}) AND has_json = 1 '
+           'ORDER BY seq DESC')
+    params = [int(seq), *feeds]
+    if limit is not None:
+        sql += ' LIMIT ?'
+        params.append(int(limit))
+    return get_conn().execute(sql, params).fetchall()[::-1]
+
+
+def hour_counts(feed, first_day=None, last_day=None):
+    """Return [(day, hour, count)] for a feed between two inclusive
+    YYYY-MM-DD days, oldest first."""
+    sql = 'SELECT day, hour, count FROM hour_counts WHERE feed = ?'
+    params = [feed]
+    if first_day is not None:
+        sql += ' AND day >= ?'
+        params.append(first_day)
+    if last_day is not None:
+        sql += ' AND day <= ?'
+        params.append(last_day)
+    sql += ' ORDER BY day, hour'
+    return get_conn().execute(sql, params).fetchall()
+
+
+def fts_query(text):
+    """Turn free text into an FTS5 query that ANDs each word as a literal
+    phrase, so quotes and operators typed by users can't break the syntax.
+    The last word also matches as a prefix. Returns None for blank input."""
+    terms = ['"%s"' % t.replace('"', '""') for t in text.split()]
+    if not terms:
+        return None
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+
+def search_calls(match, feeds, first_day=None, last_day=None, limit=20, offset=0):
+    """Best-ranked (bm25) calls matching an FTS5 query, with a snippet of the
+    best matching transcript. Returns up to ``limit + 1`` rows so callers can
+    tell whether another page exists."""
+    sql = ('SELECT c.feed, c.filename, c.stem, c.day, c.has_json, c.transcript, c.edited_transcript, c.edited, '
+           "snippet(calls_fts, -1, '[', ']', '…', 16) AS snippet, bm25(calls_fts) AS score "
+           'FROM calls_fts JOIN calls c ON c.id = calls_fts.rowid '
+           f'WHERE calls_fts MATCH ? AND c.feed IN ({", ".join("?" * len(feeds))})')
+    params = [match, *feeds]
+    if first_day is not None:
+        sql += ' AND c.day >= ?'
+        params.append(first_day)
+    if last_day is not None:
+        sql += ' AND c.day <= ?'
+        params.append(last_day)
+    sql += ' ORDER BY score, c.stem DESC LIMIT ? OFFSET ?'
+    params.extend([int(limit) + 1, int(offset)])
+    return get_conn().execute(sql, params).fetchall()
+
+
+def page_calls(feeds, limit, before=None, after=None, columns="*"):
+    """Keyset page across feeds, ordered newest first by (stem, feed).
+
+    ``before`` / ``after`` are (stem, feed) cursors; feed may be None to bound
+    on the timestamp alone. Each feed is read with its own (feed, stem) index
+    range, so a page costs the same however deep it is. Returns up to
+    ``limit + 1`` rows so callers can tell whether another page exists.
+    """
+    cursor = before or after
+    newer = before is None and after is not None
+    rows = []
+    conn = get_conn()
+    for feed in feeds:
+        sql = f'SELECT {columns} FROM calls WHERE feed = ?'
+        params = [feed]
+        if cursor:
+            stem, cursor_feed = cursor
+            if newer:
+                inclusive = cursor_feed is not None and feed > cursor_feed
+                sql += ' AND stem >= ?' if inclusive else ' AND stem > ?'
+            else:
+                inclusive = cursor_feed is not None and feed < cursor_feed
+                sql += ' AND stem <= ?' if inclusive else ' AND stem < ?'
+            params.append(stem)
+        sql += ' ORDER BY stem ASC' if newer else ' ORDER BY stem DESC'
+        sql += ' LIMIT ?'
+        params.append(int(limit) + 1)
+        rows.extend(conn.execute(sql, params).fetchall())
+    rows.sort(key=lambda r: (r["stem"], r["feed"]), reverse=not newer)
+    rows = rows[:int(limit) + 1]
+    if newer:
+        rows.reverse()
+    return rows
+
+
+def get_call(filename, feeds=FEEDS):
+    """Look up a call by filename, preferring feeds in the order given."""
+    rows = get_conn().execute('SELECT * FROM calls WHERE filename = ?', (filename,)).fetchall()
+    by_feed = {r["feed"]: r for r in rows}
+    for feed in feeds:
+        if feed in by_feed:
+            return by_feed[feed]
+    return None
+
+
+def find_feed(filename, feeds=FEEDS):
+    """Return the first of ``feeds`` that has a call with this filename."""
+    rows = get_conn().execute('SELECT feed FROM calls WHERE filename = ?', (filename,)).fetchall()
+    found = {r[0] for r in rows}
+    for feed in feeds:
+        if feed in found:
+            return feed
+    return None
+
+
+def row_metadata(row):
+    """Decode a row's metadata blob through the shared metadata cache, which
+    is keyed by the sidecar path and the (mtime_ns, size) it was indexed at."""
+    if not row["metadata"]:
+        return None
+    path = feed_dir(row["feed"]) / f"{row['stem']}.json"
+    sig = (row["json_mtime_ns"], row["json_size"])
+    data = meta_cache.lookup(path, sig)
+    if data is None:
+        data = json.loads(row["metadata"])
+        meta_cache.store(path, sig, data)
+    return data
@@ -0,0 +1,112 @@
+import os
+import queue
+import threading
+
+import call_index
+
+# Fan-out of newly published calls to live listeners (the /scanner/stream SSE
+# endpoint). One detector thread per process watches the index generation and
+# reads each new call once; every connected listener gets the same formatted
+# record from its own queue. Listeners that fall too far behind are dropped and
+# resume from their Last-Event-ID on reconnect.
+POLL_INTERVAL = float(os.environ.get('CALL_STREAM_POLL', '0.5'))
+LISTENER_QUEUE_SIZE = 256
+# Most calls replayed to a reconnecting listener.
+BACKLOG_LIMIT = 100
+
+
+class CallStream:
+    def __init__(self, format_call, feeds=call_index.FEEDS, poll_interval=POLL_INTERVAL):
+        """format_call(row) turns an index row into the record sent to
+        listeners; it runs once per call, not once per listener."""
+        self.format_call = format_call
+        self.feeds = feeds
+        self.poll_interval = poll_interval
+        self.last_seq = None
+        self._listeners = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self.last_seq = call_index.max_seq()
+                self._thread = threading.Thread(target=self.run, name='call-stream', daemon=True)
+                self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def subscribe(self):
+        """Register a listener and return (queue, seq): the queue gets every
+        (seq, feed, record) event published after seq. A None event means
+        the listener was dropped for lagging."""
+        self.start()
+        q = queue.Queue(LISTENER_QUEUE_SIZE)
+        with self._lock:
+            self._listeners.add(q)
+            return q, self.last_seq
+
+    def unsubscribe(self, q):
+        with self._lock:
+            self._listeners.discard(q)
+
+    def backlog(self, seq, feeds):
+        """Events published after seq, for a listener resuming a stream."""
+        return [(row["seq"], row["feed"], self.format_call(row))
+                for row in call_index.calls_since(seq, feeds, limit=BACKLOG_LIMIT)]
+
+    def listener_count(self):
+        with self._lock:
+            return len(self._listeners)
+
+    def run(self):
+        generation = None
+        while not self._stop.wait(self.poll_interval):
+            try:
+                if not self.listener_count():
+                    # Nobody to tell; just keep the head current so the next
+                    # listener starts from now rather than from the last one.
+                    head = call_index.max_seq()
+                    with self._lock:
+                        if not self._listeners:
+                            self.last_seq = head
+                    continue
+                for feed in self.feeds:
+                    call_index.refresh(feed)
+                current = call_index.get_generation()
+                if current == generation:
+                    continue
+                generation = current
+                self._publish(call_index.calls_since(self.last_seq, self.feeds))
+            except Exception as e:
+                print('call_stream error', e)
+
+    def _publish(self, rows):
+        for row in rows:
+            try:
+                event = (row["seq"], row["feed"], self.format_call(row))
+            except Exception as e:
+                # skip it rather than retry it forever and stall the stream
+                print('call_stream format error', row["feed"], row["stem"], e)
+                with self._lock:
+                    self.last_seq = row["seq"]
+                continue
+            # advance the head and pick the recipients together, so a
+            # listener subscribing now either gets this event or starts after it
+            with self._lock:
+                self.last_seq = row["seq"]
+                listeners = list(self._listeners)
+            for q in listeners:
+                try:
+                    q.put_nowait(event)
+                except queue.Full:
+                    self.unsubscribe(q)
+                    # make room so the listener sees that it was dropped
+                    try:
+                        q.get_nowait()
+                    except queue.Empty:
+                        pass
+                    q.put_nowait(None)
@@ -0,0 +1,78 @@
+import os
+import json
+import threading
+from collections import OrderedDict
+
+# Process-wide cache of parsed call sidecar JSON. Entries are keyed by path and
+# only served while the file's (mtime_ns, size) still match what was parsed, so
+# a rewritten sidecar is picked up on the next read without explicit
+# invalidation. Writers in this process should still call invalidate() so the
+# stale entry doesn't occupy a slot.
+MAX_ENTRIES = int(os.environ.get('META_CACHE_SIZE', '4096'))
+
+_entries = OrderedDict()  # path -> ((mtime_ns, size), data)
+_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+
+def signature(path):
+    st = os.stat(path)
+    return (st.st_mtime_ns, st.st_size)
+
+
+def lookup(path, sig):
+    """Return the cached data for path if it was parsed at signature sig."""
+    key = os.fspath(path)
+    with _lock:
+        entry = _entries.get(key)
+        if entry is not None and entry[0] == tuple(sig):
+            _entries.move_to_end(key)
+            _stats['hits'] += 1
+            return entry[1]
+        _stats['misses'] += 1
+    return None
+
+
+def store(path, sig, data):
+    key = os.fspath(path)
+    with _lock:
+        _entries[key] = (tuple(sig), data)
+        _entries.move_to_end(key)
+        while len(_entries) > MAX_ENTRIES:
+            _entries.popitem(last=False)
+            _stats['evictions'] += 1
+
+
+def load_json(path, sig=None):
+    """Return the parsed JSON at path, from cache when the file is unchanged.
+
+    The returned object is shared between callers: treat it as read-only and
+    copy it before modifying. Raises like open()/json.load() on failure.
+    """
+    sig = sig or signature(path)
+    data = lookup(path, sig)
+    if data is None:
+        with open(path) as f:
+            data = json.load(f)
+        store(path, sig, data)
+    return data
+
+
+def invalidate(*paths):
+    with _lock:
+        for path in paths:
+            if _entries.pop(os.fspath(path), None) is not None:
+                _stats['invalidations'] += 1
+
+
+def clear():
+    with _lock:
+        _entries.clear()
+
+
+def stats():
+    with _lock:
+        out = dict(_stats)
+        out['size'] = len(_entries)
+        out['max_entries'] = MAX_ENTRIES
+    return out
@@ -0,0 +1,105 @@
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from pathlib import Path
+
+import meta_cache
+
+# Writes to call and segment sidecar JSON. Every write holds an exclusive
+# lock on the file for its whole read-modify-write, so concurrent labelers
+# and editors (threads or processes) never lose each other's changes. The
+# new JSON goes to a temp file in the same directory that replaces the
+# sidecar with os.replace(), so readers see the old file or the new one and
+# never a truncated one. The locks are flock()s on small files under
+# LOCK_DIR rather than on the sidecar, whose inode changes with every replace.
+# Sidecars hash onto LOCK_STRIPES lock files, so the directory stays small;
+# two sidecars sharing a stripe just serialize.
+LOCK_DIR = Path(os.environ.get('META_LOCK_DIR', os.path.join(tempfile.gettempdir(), 'scanner_meta_locks')))
+LOCK_STRIPES = int(os.environ.get('META_LOCK_STRIPES', '64'))
+
+
+def _stripe(path):
+    digest = hashlib.sha1(os.fsencode(os.path.abspath(path))).digest()
+    return int.from_bytes(digest[:8], 'big') % LOCK_STRIPES
+
+
+class _Locks:
+    """Exclusive locks on several sidecars' stripes, each taken once and in
+    a fixed order so two batches can never deadlock."""
+
+    def __init__(self, paths):
+        self.stripes = sorted({_stripe(p) for p in paths})
+        self.fds = []
+
+    def __enter__(self):
+        LOCK_DIR.mkdir(parents=True, exist_ok=True)
+        try:
+            for stripe in self.stripes:
+                fd = os.open(LOCK_DIR / f"{stripe:03d}.lock", os.O_RDWR | os.O_CREAT, 0o644)
+                self.fds.append(fd)
+                fcntl.flock(fd, fcntl.LOCK_EX)
+        except BaseException:
+            self.__exit__()
+            raise
+        return self
+
+    def __exit__(self, *exc):
+        for fd in reversed(self.fds):
+            os.close(fd)  # closing releases the flock
+        self.fds = []
+
+
+def update_json(path, fn):
+    """Apply fn(data) -> data to one sidecar under its lock and write the
+    result atomically. Returns the new data."""
+    return update_many([(path, fn)])[Path(path)]
+
+
+def update_many(updates):
+    """Apply a batch of (path, fn) updates: fn gets a private copy of the
+    sidecar's current JSON and returns the new JSON. Several updates to one
+    path are applied in order. All files are locked, rewritten to temp files,
+    fsynced in a single pass, swapped in and their directories fsynced once.
+    Returns {path: new data}.
+
+    Raises (writing nothing) if any sidecar can't be read or any fn fails.
+    """
+    by_path = {}
+    for path, fn in updates:
+        by_path.setdefault(Path(path), []).append(fn)
+    results, temps = {}, []
+    with _Locks(by_path):
+        try:
+            for path, fns in by_path.items():
+                with open(path) as f:
+                    data = json.load(f)
+                for fn in fns:
+                    data = fn(data)
+                tmp = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+                with open(tmp, "w") as f:
+                    json.dump(data, f, indent=2)
+                temps.append((tmp, path))
+                results[path] = data
+            for tmp, _ in temps:
+                fd = os.open(tmp, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+        except BaseException:
+            for tmp, _ in temps:
+                tmp.unlink(missing_ok=True)
+            raise
+        for tmp, path in temps:
+            os.replace(tmp, path)
+        for directory in {path.parent for path in by_path}:
+            fd = os.open(directory, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+    meta_cache.invalidate(*by_path)
+    return results
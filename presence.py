@@ -0,0 +1,150 @@
+import os
+import time
+
+import redis
+
+# Who is listening right now, shared by every web process through Redis.
+# The sorted set ACTIVE_KEY scores each client_id by its last heartbeat, so
+# recording a heartbeat is one ZADD, expiring old clients is a
+# ZREMRANGEBYSCORE and counting is a ZCOUNT. The details shown by
+# /scanner/admin/active (ip, user agent, page) live in a small hash per
+# client that expires on its own.
+#
+# Heartbeats are also folded into listener rollups that outlive presence:
+# HyperLogLogs of unique client_ids per hour and per day (overall and per
+# page), and per hour/day sorted sets holding each page's peak concurrent
+# listeners (ZADD GT keeps the maximum). No per-client history is kept.
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://127.0.0.1:6379/0')
+ACTIVE_TIMEOUT = int(os.environ.get('ACTIVE_TIMEOUT', '120'))  # seconds considered "active"
+ACTIVE_KEY = 'presence:active'
+CLIENT_PREFIX = 'presence:client:'
+PAGE_PREFIX = 'presence:page:'  # sorted set of the clients on each page
+UNIQUE_PREFIX = 'stats:listeners:'  # + hour/day key [+ ':' + page]: HyperLogLog
+PEAK_PREFIX = 'stats:peak:'  # + hour/day key: page -> peak concurrent listeners
+ALL_PAGES = '*'
+HOUR_TTL = 8 * 24 * 3600
+DAY_TTL = 400 * 24 * 3600
+# Pages tracked separately; any other path a client reports counts as
+# OTHER_PAGE, so clients can't mint new keys.
+PAGES = {
+    '/scanner': '/scanner',
+    '/scanner_pd': '/scanner_pd',
+    '/scanner_fire': '/scanner_fire',
+    '/scanner_fd': '/scanner_fire',
+    '/scanner/archive': '/scanner/archive',
+    '/scanner_fire/archive': '/scanner_fire/archive',
+    '/scanner/segments': '/scanner/segments',
+}
+OTHER_PAGE = 'other'
+
+redis_client = redis.from_url(REDIS_URL)
+
+
+def _page(page):
+    """Clients report location.pathname; map it onto PAGES."""
+    path = (page or '').split('?', 1)[0].strip().rstrip('/')
+    return PAGES.get(path, OTHER_PAGE)
+
+
+def _periods(now):
+    """(key, ttl) of the hour and the day containing now, in local time."""
+    t = time.localtime(now)
+    return (('hour:' + time.strftime('%Y%m%d%H', t), HOUR_TTL),
+            ('day:' + time.strftime('%Y%m%d', t), DAY_TTL))
+
+
+def heartbeat(client_id, ip, ua, page, now=None, r=None):
+    """Mark client_id as active and fold the heartbeat into the rollups.
+    Two pipelined round trips: the second records concurrency peaks from
+    the counts the first returns."""
+    r = r or redis_client
+    now = time.time() if now is None else now
+    cutoff = now - ACTIVE_TIMEOUT
+    page = _page(page)
+    key = CLIENT_PREFIX + client_id
+    page_key = PAGE_PREFIX + page
+    pipe = r.pipeline(transaction=False)
+    pipe.hget(key, 'page')
+    pipe.zadd(ACTIVE_KEY, {client_id: now})
+    pipe.hset(key, mapping={'ip': ip or '', 'ua': ua or '', 'page': page})
+    pipe.expire(key, ACTIVE_TIMEOUT * 2)
+    pipe.zremrangebyscore(ACTIVE_KEY, '-inf', cutoff)
+    pipe.zcard(ACTIVE_KEY)
+    pipe.zadd(page_key, {client_id: now})
+    pipe.expire(page_key, ACTIVE_TIMEOUT * 2)
+    pipe.zremrangebyscore(page_key, '-inf', cutoff)
+    pipe.zcard(page_key)
+    for period, ttl in _periods(now):
+        for unique_key in (UNIQUE_PREFIX + period, f"{UNIQUE_PREFIX}{period}:{page}"):
+            pipe.pfadd(unique_key, client_id)
+            pipe.expire(unique_key, ttl)
+    res = pipe.execute()
+    previous, total, on_page = res[0], res[5], res[9]
+    pipe = r.pipeline(transaction=False)
+    if previous is not None and previous.decode(errors='replace') != page:
+        # the client moved on; it no longer counts towards its last page
+        pipe.zrem(PAGE_PREFIX + previous.decode(errors='replace'), client_id)
+    for period, ttl in _periods(now):
+        pipe.zadd(PEAK_PREFIX + period, {ALL_PAGES: total, page: on_page}, gt=True)
+        pipe.expire(PEAK_PREFIX + period, ttl)
+    pipe.execute()
+
+
+def active_clients(limit=500, now=None, r=None):
+    """Active clients, most recently seen first, and the total count."""
+    r = r or redis_client
+    now = time.time() if now is None else now
+    cutoff = now - ACTIVE_TIMEOUT
+    pipe = r.pipeline(transaction=False)
+    pipe.zremrangebyscore(ACTIVE_KEY, '-inf', cutoff)
+    pipe.zcount(ACTIVE_KEY, cutoff, '+inf')
+    pipe.zrevrangebyscore(ACTIVE_KEY, '+inf', cutoff, start=0, num=limit, withscores=True)
+    _, count, members = pipe.execute()
+    pipe = r.pipeline(transaction=False)
+    for client_id, _ in members:
+        pipe.hgetall(CLIENT_PREFIX + client_id.decode())
+    details = pipe.execute()
+    active = []
+    for (client_id, last_seen), info in zip(members, details):
+        info = {k.decode(): v.decode(errors='replace') for k, v in info.items()}
+        active.append({
+            'client_id': client_id.decode(),
+            'ip': info.get('ip', ''),
+            'ua': info.get('ua', ''),
+            'page': info.get('page', ''),
+            'last_seen': last_seen,
+        })
+    return count, active
+
+
+def listener_stats(hours=24, days=7, now=None, r=None):
+    """Rollups for the last `hours` hours and `days` days, newest first:
+    unique listeners and peak concurrent listeners, overall and per page."""
+    r = r or redis_client
+    now = time.time() if now is None else now
+    periods = ([('hour', now - i * 3600) for i in range(hours)] +
+               [('day', now - i * 86400) for i in range(days)])
+    keys = []
+    for kind, t in periods:
+        fmt = '%Y%m%d%H' if kind == 'hour' else '%Y%m%d'
+        keys.append((kind, f"{kind}:{time.strftime(fmt, time.localtime(t))}"))
+    pipe = r.pipeline(transaction=False)
+    for _, period in keys:
+        pipe.zrange(PEAK_PREFIX + period, 0, -1, withscores=True)
+    peaks = [{m.decode(errors='replace'): int(score) for m, score in rows} for rows in pipe.execute()]
+    pipe = r.pipeline(transaction=False)
+    for (_, period), period_peaks in zip(keys, peaks):
+        pipe.pfcount(UNIQUE_PREFIX + period)
+        for page in period_peaks:
+            if page != ALL_PAGES:
+                pipe.pfcount(f"{UNIQUE_PREFIX}{period}:{page}")
+    counts = iter(pipe.execute())
+    out = {'hours': [], 'days': []}
+    for (kind, period), period_peaks in zip(keys, peaks):
+        entry = {kind: period.split(':', 1)[1], 'unique': next(counts), 'peak': period_peaks.get(ALL_PAGES, 0),
+                 'pages': {}}
+        for page, peak in sorted(period_peaks.items()):
+            if page != ALL_PAGES:
+                entry['pages'][page] = {'unique': next(counts), 'peak': peak}
+        out[kind + 's'].append(entry)
+    return out
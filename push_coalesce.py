@@ -0,0 +1,119 @@
+import json
+import os
+import time
+
+import redis
+
+import push_jobs
+
+# Coalescing in front of push_queue. During an incident calls land faster
+# than anyone wants to be notified, so jobs are not queued directly: each is
+# parked in a per-topic bucket, and the first job in an empty bucket starts a
+# WINDOW-second timer. When it expires the worker replaces the whole bucket
+# with one job: the original message if it was alone, otherwise a digest
+# ("7 new PD calls") that targets the union of the merged jobs' keywords and
+# units. Each topic therefore costs at most one fan-out per window.
+WINDOW = float(os.environ.get('PUSH_COALESCE_WINDOW', '30'))
+QUEUE_KEY = 'push_queue'
+BUCKET_PREFIX = 'push_coalesce:'
+DUE_KEY = 'push_coalesce_due'  # sorted set: bucket key -> flush time
+# A bucket keeps at most this many jobs; a digest only needs the count and
+# the latest few messages.
+BUCKET_MAX = 200
+FEED_LABELS = {'pd': 'PD', 'fd': 'Fire'}
+
+
+def bucket_key(topic):
+    """Jobs for the same feed (and the same explicit units) share a bucket.
+    Keywords don't split buckets; they come from each call's own words."""
+    topic = topic or {}
+    feed = (topic.get('feed') or '*').lower()
+    units = ','.join(sorted({str(u).strip().lower() for u in topic.get('units') or []}))
+    return f"{BUCKET_PREFIX}{feed}:{units}"
+
+
+def enqueue(r, job, window=None):
+    """Queue a push job, coalescing it with others for the same topic. With
+    a window of 0 the job goes straight onto push_queue."""
+    window = WINDOW if window is None else window
+    if window <= 0:
+        r.lpush(QUEUE_KEY, json.dumps(job))
+        return
+    key = bucket_key(job.get('topic'))
+    job = dict(job, queued_at=time.time())
+    pipe = r.pipeline(transaction=True)
+    pipe.rpush(key, json.dumps(job))
+    pipe.ltrim(key, -BUCKET_MAX, -1)
+    pipe.incr(key + ':count')
+    # nx: only the first job in an empty bucket sets the flush time
+    pipe.zadd(DUE_KEY, {key: time.time() + window}, nx=True)
+    pipe.execute()
+
+
+def flush_due(r, now=None):
+    """Turn every bucket whose window has closed into a single push_queue
+    job. Returns the number of jobs queued."""
+    now = time.time() if now is None else now
+    queued = 0
+    for key in r.zrangebyscore(DUE_KEY, '-inf', now):
+        key = key.decode() if isinstance(key, bytes) else key
+        jobs, job = _flush_bucket(r, key)
+        if job is None:
+            continue
+        # the digest carries the newest job's id; the rest point at it
+        for merged in jobs[:-1]:
+            push_jobs.update(r, merged.get('job_id'), status='coalesced', into=job.get('job_id') or '')
+        queued += 1
+    return queued
+
+
+def _flush_bucket(r, key):
+    """Replace one bucket with its digest on push_queue in a single
+    transaction: the bucket is cleared and the digest queued together, so a
+    job can neither land in between nor be lost if the worker dies. Returns
+    (bucket jobs, digest or None)."""
+    with r.pipeline(transaction=True) as pipe:
+        while True:
+            try:
+                pipe.watch(key, key + ':count')
+                items = pipe.lrange(key, 0, -1)
+                count = pipe.get(key + ':count')
+                jobs = [json.loads(i) for i in items]
+                job = digest(jobs, int(count or len(jobs))) if jobs else None
+                pipe.multi()
+                pipe.delete(key, key + ':count')
+                pipe.zrem(DUE_KEY, key)
+                if job is not None:
+                    pipe.lpush(QUEUE_KEY, json.dumps(job))
+                pipe.execute()
+                return jobs, job
+            except redis.WatchError:
+                continue  # a job joined the bucket meanwhile; read it again
+
+
+def digest(jobs, count=None):
+    """Merge a bucket's jobs (oldest first) into one job."""
+    count = count or len(jobs)
+    latest = jobs[-1]
+    if count == 1:
+        return latest
+    topic = dict(latest.get('topic') or {})
+    keywords, units = set(), set()
+    for job in jobs:
+        t = job.get('topic') or {}
+        keywords.update(t.get('keywords') or [])
+        units.update(t.get('units') or [])
+    topic['keywords'] = sorted(keywords)
+    topic['units'] = sorted(units)
+    feed = (topic.get('feed') or '').lower()
+    label = FEED_LABELS.get(feed, '')
+    title = f"{count} new {label + ' ' if label else ''}calls"
+    return {
+        'title': title,
+        'message': latest.get('message'),
+        'topic': topic,
+        'tag': f"scanner-{feed or 'all'}",
+        'job_id': latest.get('job_id'),
+        'coalesced': count,
+        'first_queued_at': jobs[0].get('queued_at'),
+    }
@@ -1,13 +1,57 @@
-import sqlite3
 import os
 import json
+import re
+import time
+
+import sqlite_db
 
 DB_PATH = os.path.join(os.path.dirname(__file__), 'push_subs.sqlite3')
 
+# Delivery bookkeeping added to subscriptions after the table first shipped;
+# ensure_db() adds any that an existing database lacks.
+DELIVERY_COLUMNS = {
+    'failures': 'INTEGER NOT NULL DEFAULT 0',
+    'backoff_until': 'REAL',
+    'last_status': 'INTEGER',
+    'last_attempt': 'REAL',
+    'window_start': 'REAL',
+    'window_sent': 'INTEGER NOT NULL DEFAULT 0',
+}
+# Retryable failures (429, 5xx, network errors) back off exponentially from
+# BACKOFF_BASE seconds up to BACKOFF_MAX, or longer if Retry-After says so.
+BACKOFF_BASE = 60
+BACKOFF_MAX = 24 * 3600
+# Per-subscriber rate cap: at most RATE_CAP pushes per RATE_WINDOW seconds
+# (a fixed window starting at the first push); capped subscribers are not
+# deliverable until their window ends. 0 disables the cap.
+RATE_CAP = int(os.environ.get('PUSH_RATE_CAP', '6'))
+RATE_WINDOW = float(os.environ.get('PUSH_RATE_WINDOW', '300'))
+# Rows fetched per round trip by iter_subscriptions().
+FETCH_SIZE = 500
+
+SAVE_SQL = ('INSERT OR REPLACE INTO subscriptions (endpoint, subscription_json, created_at) '
+            'VALUES (?, ?, strftime("%s","now"))')
+
+# Topics a subscription wants, as (kind, value) rows: 'feed' (pd/fd, or '*'
+# for every feed), 'keyword' (a lowercase word in the message) and 'unit' (a
+# speaker/unit label). A subscription always has at least one feed row; one
+# with no keyword or unit rows gets everything on its feeds.
+TOPIC_KINDS = ('feed', 'keyword', 'unit')
+FEED_TOPICS = ('pd', 'fd')
+ALL_FEEDS = '*'
+
+
+def get_conn():
+    """Return this thread's connection, creating it on first use."""
+    return _db.conn()
+
+
 def ensure_db():
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute('''
+    get_conn()
+
+
+def _ensure_schema(conn):
+    conn.execute('''
     CREATE TABLE IF NOT EXISTS subscriptions (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         endpoint TEXT UNIQUE,
@@ -15,34 +59,202 @@ def ensure_db():
         created_at INTEGER
     )
     ''')
+    existing = {row[1] for row in conn.execute('PRAGMA table_info(subscriptions)')}
+    for name, decl in DELIVERY_COLUMNS.items():
+        if name not in existing:
+            conn.execute(f'ALTER TABLE subscriptions ADD COLUMN {name} {decl}')
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS subscription_topics (
+        endpoint TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        value TEXT NOT NULL,
+        PRIMARY KEY (endpoint, kind, value)
+    ) WITHOUT ROWID
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS subscription_topics_kind_value ON subscription_topics (kind, value)')
+    # Subscriptions from before topics existed receive every feed.
+    conn.execute("INSERT OR IGNORE INTO subscription_topics (endpoint, kind, value) "
+                 "SELECT endpoint, 'feed', ? FROM subscriptions WHERE endpoint NOT IN "
+                 "(SELECT endpoint FROM subscription_topics WHERE kind = 'feed')", (ALL_FEEDS,))
     conn.commit()
-    conn.close()
 
 
-def save_subscription(subscription_json):
-    ensure_db()
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute('INSERT OR REPLACE INTO subscriptions (endpoint, subscription_json, created_at) VALUES (?, ?, strftime("%s","now"))',
-                (subscription_json.get('endpoint'), json.dumps(subscription_json)))
-    conn.commit()
-    conn.close()
+# One long-lived connection per thread (WAL, so the push worker can read while
+# the web app writes).
+_db = sqlite_db.ThreadLocalDB(lambda: DB_PATH, _ensure_schema)
+
+
+def normalize_topics(topics):
+    """Turn {'feeds': [...], 'keywords': [...], 'units': [...]} (singular keys
+    and plain strings also accepted) into sorted (kind, value) rows. Unknown
+    feeds are dropped; no feed means every feed."""
+    topics = topics or {}
+    rows = set()
+    for kind in TOPIC_KINDS:
+        values = topics.get(kind + 's', topics.get(kind)) or []
+        if isinstance(values, str):
+            values = [values]
+        for value in values:
+            value = str(value).strip().lower()
+            if not value or (kind == 'feed' and value not in FEED_TOPICS):
+                continue
+            rows.add((kind, value))
+    if not any(kind == 'feed' for kind, _ in rows):
+        rows.add(('feed', ALL_FEEDS))
+    return sorted(rows)
+
+
+def job_topic(feed=None, message='', keywords=None, units=None):
+    """The topic a push job targets. Keywords default to the words of the
+    message, so keyword subscribers hear about calls that mention them."""
+    if keywords is None:
+        keywords = re.findall(r"[\w']+", (message or '').lower())
+    return {'feed': feed, 'keywords': sorted(set(keywords)), 'units': list(units or [])}
+
+
+def save_subscription(subscription_json, topics=None):
+    save_subscriptions([subscription_json], topics)
 
 
-def list_subscriptions():
-    ensure_db()
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute('SELECT subscription_json FROM subscriptions')
-    rows = [json.loads(r[0]) for r in cur.fetchall()]
-    conn.close()
-    return rows
+def save_subscriptions(subscriptions, topics=None):
+    """Upsert many subscriptions, all with the given topics (default: every
+    feed), in one transaction. Re-saving replaces a subscription's topics."""
+    rows = normalize_topics(topics)
+    endpoints = [(s.get('endpoint'),) for s in subscriptions]
+    conn = get_conn()
+    with conn:
+        conn.executemany(SAVE_SQL, [(s.get('endpoint'), json.dumps(s)) for s in subscriptions])
+        conn.executemany('DELETE FROM subscription_topics WHERE endpoint = ?', endpoints)
+        conn.executemany('INSERT INTO subscription_topics (endpoint, kind, value) VALUES (?, ?, ?)',
+                         [(e, kind, value) for (e,) in endpoints for kind, value in rows])
+
+
+def get_topics(endpoint):
+    return get_conn().execute('SELECT kind, value FROM subscription_topics WHERE endpoint = ? ORDER BY kind, value',
+                              (endpoint,)).fetchall()
+
+
+def _topic_filter(topic):
+    """SQL (and params) selecting the endpoints a job's topic should reach:
+    subscribers of its feed (or of every feed) that either have no keyword or
+    unit topics, or have one the job matches. Each step is an index lookup on
+    subscription_topics."""
+    feed = (topic.get('feed') or '').lower()
+    keywords = sorted({str(k).lower() for k in topic.get('keywords') or []})
+    units = sorted({str(u).strip().lower() for u in topic.get('units') or []})
+    sql = "SELECT f.endpoint FROM subscription_topics f WHERE f.kind = 'feed'"
+    params = []
+    if feed:
+        sql += ' AND f.value IN (?, ?)'
+        params.extend([feed, ALL_FEEDS])
+    interest = ["NOT EXISTS (SELECT 1 FROM subscription_topics i WHERE i.endpoint = f.endpoint "
+                "AND i.kind IN ('keyword', 'unit'))"]
+    for kind, values in (('keyword', keywords), ('unit', units)):
+        if values:
+            interest.append(f"EXISTS (SELECT 1 FROM subscription_topics i WHERE i.endpoint = f.endpoint "
+                            f"AND i.kind = '{kind}' AND i.value IN ({', '.join('?' * len(values))}))")
+            params.extend(values)
+    sql += ' AND (' + ' OR '.join(interest) + ')'
+    return sql, params
+
+
+def iter_subscriptions(deliverable=False, topic=None):
+    """Yield stored subscriptions one at a time, reading FETCH_SIZE rows per
+    page. With deliverable=True, skip those currently backing off or at
+    their rate cap. With a job ``topic`` ({'feed', 'keywords', 'units'}),
+    only its targets.
+
+    Pages are read whole and keyed by id, so no statement stays open while
+    the caller writes outcomes back between pages."""
+    sql = 'SELECT id, subscription_json FROM subscriptions WHERE id > ?'
+    where, params = [], []
+    if deliverable:
+        now = time.time()
+        where.append('(backoff_until IS NULL OR backoff_until <= ?)')
+        params.append(now)
+        if RATE_CAP > 0:
+            where.append('(window_start IS NULL OR window_start <= ? OR window_sent < ?)')
+            params.extend([now - RATE_WINDOW, RATE_CAP])
+    if topic:
+        topic_sql, topic_params = _topic_filter(topic)
+        where.append(f'endpoint IN ({topic_sql})')
+        params.extend(topic_params)
+    if where:
+        sql += ' AND ' + ' AND '.join(where)
+    sql += ' ORDER BY id LIMIT ?'
+    last_id = 0
+    while True:
+        rows = get_conn().execute(sql, [last_id] + params + [FETCH_SIZE]).fetchall()
+        if not rows:
+            return
+        last_id = rows[-1][0]
+        for _, data in rows:
+            yield json.loads(data)
+
+
+def list_subscriptions(deliverable=False, topic=None):
+    return list(iter_subscriptions(deliverable, topic))
 
 
 def remove_subscription(endpoint):
-    ensure_db()
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute('DELETE FROM subscriptions WHERE endpoint = ?', (endpoint,))
-    conn.commit()
-    conn.close()
+    remove_subscriptions([endpoint])
+
+
+def remove_subscriptions(endpoints):
+    """Delete many subscriptions in one transaction."""
+    conn = get_conn()
+    with conn:
+        conn.executemany('DELETE FROM subscriptions WHERE endpoint = ?', [(e,) for e in endpoints])
+        conn.executemany('DELETE FROM subscription_topics WHERE endpoint = ?', [(e,) for e in endpoints])
+
+
+def record_outcomes(outcomes):
+    """Apply a batch of delivery outcomes in one transaction.
+
+    outcomes: (endpoint, action, status, retry_after) tuples where action is
+    'ok' (clear failures), 'backoff' (retryable; count it and back off) or
+    'fail' (count it only). Gone subscriptions go through
+    remove_subscriptions() instead.
+    """
+    if not outcomes:
+        return
+    now = time.time()
+    ok, failed, backoff = [], [], []
+    for endpoint, action, status, retry_after in outcomes:
+        if action == 'ok':
+            ok.append((status, now, now - RATE_WINDOW, endpoint))
+        elif action == 'backoff':
+            backoff.append((BACKOFF_BASE, BACKOFF_MAX, retry_after or 0, now, status, now, endpoint))
+        else:
+            failed.append((status, now, endpoint))
+    conn = get_conn()
+    with conn:
+        if ok:
+            # a success counts towards the rate cap, starting a new window
+            # if the last one has ended
+            conn.executemany('UPDATE subscriptions SET failures = 0, backoff_until = NULL, last_status = ?1, '
+                             'last_attempt = ?2, '
+                             'window_sent = CASE WHEN window_start > ?3 THEN window_sent + 1 ELSE 1 END, '
+                             'window_start = CASE WHEN window_start > ?3 THEN window_start ELSE ?2 END '
+                             'WHERE endpoint = ?4', ok)
+        if backoff:
+            # delay = max(min(base * 2^failures, max), retry_after)
+            conn.executemany('UPDATE subscriptions SET '
+                             'backoff_until = ?4 + MAX(MIN(?1 * (1 << MIN(failures, 30)), ?2), ?3), '
+                             'failures = failures + 1, last_status = ?5, last_attempt = ?6 WHERE endpoint = ?7',
+                             backoff)
+        if failed:
+            conn.executemany('UPDATE subscriptions SET failures = failures + 1, last_status = ?, last_attempt = ? '
+                             'WHERE endpoint = ?', failed)
+
+
+def delivery_summary():
+    """Counts of subscriptions that are healthy, failing, backing off and
+    at their rate cap."""
+    now = time.time()
+    total, failing, backing_off, capped = get_conn().execute(
+        'SELECT COUNT(*), SUM(failures > 0), SUM(backoff_until > ?), '
+        'SUM(window_start > ? AND window_sent >= ?) FROM subscriptions',
+        (now, now - RATE_WINDOW, RATE_CAP)).fetchone()
+    return {'total': total, 'failing': failing or 0, 'backing_off': backing_off or 0,
+            'rate_capped': (capped or 0) if RATE_CAP > 0 else 0}
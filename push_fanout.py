@@ -0,0 +1,162 @@
+import itertools
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import push_db
+import push_utils
+
+# Sends one payload to many subscriptions in parallel. A shared thread pool
+# bounds total concurrency; within a job each push service origin (FCM,
+# Mozilla, Apple, ...) gets at most PER_ORIGIN_CONCURRENCY senders, each
+# draining that origin's share of the subscriptions. Subscriptions are taken
+# from the iterator CHUNK_SIZE at a time and each chunk is sent before the
+# next is read, so a job's memory doesn't grow with the subscriber count.
+MAX_CONCURRENCY = int(os.environ.get('PUSH_CONCURRENCY', '32'))
+PER_ORIGIN_CONCURRENCY = int(os.environ.get('PUSH_PER_ORIGIN', '8'))
+# Subscriptions read and sent per chunk.
+CHUNK_SIZE = int(os.environ.get('PUSH_FANOUT_CHUNK', '1000'))
+
+# How delivery failures are treated: the push service says the subscription
+# is gone (or its keys can't be encrypted for), or asks us to come back later
+# (429, 5xx, or it couldn't be reached). Anything else is a plain failure.
+GONE_STATUSES = (404, 410)
+
+
+def classify(ok, err):
+    """Map a send result to 'ok', 'remove', 'backoff' or 'fail'."""
+    if ok:
+        return 'ok'
+    status = getattr(err, 'status', None)
+    if status in GONE_STATUSES or getattr(err, 'invalid', False):
+        return 'remove'
+    if status == 429 or (status is not None and status >= 500):
+        return 'backoff'
+    if status is None and isinstance(err, push_utils.PushError):
+        # no response at all: a network error
+        return 'backoff'
+    return 'fail'
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENCY, thread_name_prefix='push')
+        return _executor
+
+
+def _drain(pending, payload, vapid_private_key, vapid_claims, send, progress, abort):
+    results = []
+    while not abort.is_set():
+        try:
+            s = pending.popleft()
+        except IndexError:
+            break
+        started = time.time()
+        try:
+            ok, err = send(s, payload, vapid_private_key, vapid_claims)
+        except Exception as e:
+            # send raises only for failures that hit every subscription
+            # (e.g. the VAPID key): stop the job
+            abort.set()
+            return results, e
+        entry = {'endpoint': s.get('endpoint'), 'ok': bool(ok), 'action': classify(ok, err),
+                 'latency': round(time.time() - started, 4)}
+        if err:
+            entry['error'] = str(err)
+            entry['status'] = getattr(err, 'status', None)
+            entry['retry_after'] = getattr(err, 'retry_after', None)
+        if progress is not None:
+            progress.add(entry)
+        results.append(entry)
+    return results, None
+
+
+def _send_chunk(chunk, payload, vapid_private_key, vapid_claims, per_origin, send, progress):
+    """Send to one chunk of subscriptions, per_origin senders per origin.
+    Returns (results, first exception raised by send or None)."""
+    by_origin = defaultdict(deque)
+    for s in chunk:
+        by_origin[push_utils.endpoint_origin(s)].append(s)
+    executor = _get_executor()
+    abort = threading.Event()
+    futures = []
+    for pending in by_origin.values():
+        for _ in range(min(per_origin, len(pending))):
+            futures.append(executor.submit(_drain, pending, payload, vapid_private_key, vapid_claims, send,
+                                           progress, abort))
+    results, error = [], None
+    for f in futures:
+        drained, e = f.result()
+        results.extend(drained)
+        error = error or e
+    return results, error
+
+
+def fan_out(subscriptions, payload, vapid_private_key, vapid_claims,
+            per_origin=PER_ORIGIN_CONCURRENCY, send=push_utils.send_push, record=True, progress=None,
+            chunk_size=CHUNK_SIZE, keep_results=True):
+    """Send payload to every subscription and wait for all of them.
+
+    Subscriptions are read chunk_size at a time, so memory stays bounded
+    however many there are. With ``record``, each chunk's outcomes are
+    written back to push_db: gone subscriptions (404/410, or keys that
+    can't be encrypted for) are removed,
+    retryable failures (429, 5xx, network errors) back off, and successes
+    clear the failure count. ``progress`` (e.g. push_jobs.JobProgress) gets
+    start() before the first send, add_total(n) as each chunk is read,
+    add(entry) per result and flush() at the end.
+    If send raises (a job-wide error such as a bad VAPID key) the
+    remaining sends are skipped, the outcomes so far are recorded and the
+    exception is re-raised so the job can be retried.
+
+    Returns (stats, results): stats has total/sent/failed/removed/backoff
+    counts, elapsed seconds and per-origin counts; results has one
+    {'endpoint', 'ok', 'action', 'latency', 'error'?, 'status'?} entry per
+    subscription (None unless ``keep_results``).
+    """
+    started = time.time()
+    stats = {'total': 0, 'sent': 0, 'failed': 0, 'removed': 0, 'backoff': 0}
+    origins = {}
+    kept = [] if keep_results else None
+    subscriptions = iter(subscriptions)
+    if progress is not None:
+        progress.start()
+    try:
+        while True:
+            chunk = list(itertools.islice(subscriptions, chunk_size))
+            if not chunk:
+                break
+            if progress is not None:
+                progress.add_total(len(chunk))
+            results, error = _send_chunk(chunk, payload, vapid_private_key, vapid_claims, per_origin, send,
+                                         progress)
+            if record:
+                push_db.remove_subscriptions([r['endpoint'] for r in results if r['action'] == 'remove'])
+                push_db.record_outcomes([(r['endpoint'], r['action'], r.get('status'), r.get('retry_after'))
+                                         for r in results if r['action'] != 'remove'])
+            for r in results:
+                counts = origins.setdefault(push_utils.endpoint_origin(r), {'total': 0, 'sent': 0})
+                counts['total'] += 1
+                counts['sent'] += int(r['ok'])
+                stats['total'] += 1
+                stats['sent' if r['ok'] else 'failed'] += 1
+                if r['action'] in ('remove', 'backoff'):
+                    stats['removed' if r['action'] == 'remove' else 'backoff'] += 1
+            if kept is not None:
+                kept.extend(results)
+            if error is not None:
+                raise error
+    finally:
+        if progress is not None:
+            progress.flush()
+    stats['elapsed'] = round(time.time() - started, 3)
+    stats['origins'] = origins
+    return stats, kept
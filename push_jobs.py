@@ -0,0 +1,147 @@
+import bisect
+import threading
+import time
+import uuid
+
+# Progress of queued push jobs, kept in Redis so the web tier can report on
+# jobs the push workers are running. Each job has a hash push_job:<id> with
+# its status, timestamps and sent/failed/removed/backoff counters, and a hash
+# push_job:<id>:latency counting sends per latency bucket, from which
+# /scanner/push/jobs/<id> derives percentiles. Both expire after JOB_TTL.
+JOB_PREFIX = 'push_job:'
+JOB_TTL = 24 * 3600
+# Latency bucket upper bounds in milliseconds; slower sends count as 'inf'.
+LATENCY_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+PERCENTILES = (50, 90, 99)
+# Worker-side counters are batched and written at most this often.
+FLUSH_INTERVAL = 0.5
+COUNTERS = ('sent', 'failed', 'removed', 'backoff')
+
+
+def _key(job_id):
+    return JOB_PREFIX + job_id
+
+
+def create(r, job):
+    """Give job an id and record it as queued. Returns the id."""
+    job_id = uuid.uuid4().hex
+    job['job_id'] = job_id
+    pipe = r.pipeline()
+    pipe.hset(_key(job_id), mapping={'status': 'queued', 'created_at': time.time(),
+                                     'message': job.get('message') or ''})
+    pipe.expire(_key(job_id), JOB_TTL)
+    pipe.execute()
+    return job_id
+
+
+def update(r, job_id, **fields):
+    if not job_id:
+        return
+    pipe = r.pipeline()
+    pipe.hset(_key(job_id), mapping=fields)
+    pipe.expire(_key(job_id), JOB_TTL)
+    pipe.execute()
+
+
+def get(r, job_id):
+    """The job's status and counters with latency percentiles, or None."""
+    raw = r.hgetall(_key(job_id))
+    if not raw:
+        return None
+    job = {k.decode(): v.decode() for k, v in raw.items()}
+    for k in ('total',) + COUNTERS:
+        job[k] = int(job.get(k, 0))
+    for k in ('created_at', 'started_at', 'finished_at', 'elapsed'):
+        if k in job:
+            job[k] = float(job[k])
+    if 'attempts' in job:
+        job['attempts'] = int(job['attempts'])
+    histogram = {k.decode(): int(v) for k, v in r.hgetall(_key(job_id) + ':latency').items()}
+    job['latency_ms'] = percentiles(histogram)
+    job['job_id'] = job_id
+    return job
+
+
+def percentiles(histogram):
+    """{'p50': ms, ...} from bucket counts: each value is the upper bound of
+    the bucket the percentile falls in (None for the 'inf' bucket)."""
+    bounds = [str(b) for b in LATENCY_BUCKETS_MS] + ['inf']
+    counts = [histogram.get(b, 0) for b in bounds]
+    total = sum(counts)
+    out = {}
+    for p in PERCENTILES:
+        if not total:
+            out[f"p{p}"] = None
+            continue
+        rank = total * p / 100
+        seen = 0
+        for bound, count in zip(bounds, counts):
+            seen += count
+            if seen >= rank:
+                out[f"p{p}"] = None if bound == 'inf' else int(bound)
+                break
+    return out
+
+
+class JobProgress:
+    """fan_out() progress hook that tallies results and writes them to the
+    job's Redis hashes in batches."""
+
+    def __init__(self, r, job_id):
+        self.r = r
+        self.job_id = job_id
+        self._lock = threading.Lock()
+        self._counts = {}
+        self._latency = {}
+        self._last_flush = 0
+
+    def start(self, total=0):
+        key = _key(self.job_id)
+        pipe = self.r.pipeline()
+        # a retried job starts counting again
+        pipe.hdel(key, *COUNTERS)
+        pipe.delete(key + ':latency')
+        pipe.hset(key, mapping={'status': 'running', 'started_at': time.time(), 'total': total})
+        pipe.expire(key, JOB_TTL)
+        pipe.execute()
+
+    def add_total(self, n):
+        """Count n more subscriptions to send to (fan_out reads them in
+        chunks); written straight away so the total leads the counters."""
+        with self._lock:
+            self._counts['total'] = self._counts.get('total', 0) + n
+        self.flush()
+
+    def add(self, entry):
+        # as in fan_out() stats, removed and backoff are subsets of failed
+        counters = ['sent'] if entry['ok'] else ['failed']
+        if entry['action'] == 'remove':
+            counters.append('removed')
+        elif entry['action'] == 'backoff':
+            counters.append('backoff')
+        ms = entry.get('latency', 0) * 1000
+        i = bisect.bisect_left(LATENCY_BUCKETS_MS, ms)
+        bucket = str(LATENCY_BUCKETS_MS[i]) if i < len(LATENCY_BUCKETS_MS) else 'inf'
+        with self._lock:
+            for counter in counters:
+                self._counts[counter] = self._counts.get(counter, 0) + 1
+            self._latency[bucket] = self._latency.get(bucket, 0) + 1
+            if time.time() - self._last_flush < FLUSH_INTERVAL:
+                return
+        self.flush()
+
+    def flush(self):
+        with self._lock:
+            counts, latency = self._counts, self._latency
+            self._counts, self._latency = {}, {}
+            self._last_flush = time.time()
+        if not counts:
+            return
+        key = _key(self.job_id)
+        pipe = self.r.pipeline()
+        for name, n in counts.items():
+            pipe.hincrby(key, name, n)
+        for bucket, n in latency.items():
+            pipe.hincrby(key + ':latency', bucket, n)
+        pipe.expire(key + ':latency', JOB_TTL)
+        pipe.execute()
@@ -1,14 +1,62 @@
+import base64
 import os
 import json
-from base64 import urlsafe_b64encode, urlsafe_b64decode
-from pywebpush import webpush, WebPushException
-from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.primitives.asymmetric import ec
-import base64
+import time
+from email.utils import parsedate_to_datetime
+from pywebpush import WebPusher, WebPushException
+from py_vapid import Vapid01, Vapid02
+import threading
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
 
 VAPID_PUBLIC_FILE = os.path.join(os.path.dirname(__file__), 'vapid_public.key')
 VAPID_PRIVATE_FILE = os.path.join(os.path.dirname(__file__), 'vapid_private.key')
 
+# Keep-alive connection pools, one requests.Session per push service origin,
+# shared by every sender in the process so each origin's TLS handshake is paid
+# once rather than per message.
+POOL_SIZE = int(os.environ.get('PUSH_POOL_SIZE', '8'))
+PUSH_TIMEOUT = float(os.environ.get('PUSH_TIMEOUT', '10'))
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def endpoint_origin(subscription):
+    endpoint = subscription.get('endpoint') if isinstance(subscription, dict) else None
+    parts = urlsplit(endpoint or '')
+    return f"{parts.scheme}://{parts.netloc}" if parts.netloc else 'unknown'
+
+
+def session_for(subscription_info):
+    """Return the pooled session for the subscription's push service."""
+    origin = endpoint_origin(subscription_info)
+    with _sessions_lock:
+        session = _sessions.get(origin)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _sessions[origin] = session
+        return session
+
+
+# Parsed VAPID keys and the signed JWT per push service audience. RFC 8292
+# allows tokens up to 24h; ours live 12h and are re-signed shortly before.
+JWT_LIFETIME = 12 * 3600
+JWT_REFRESH_MARGIN = 300
+_vapid_lock = threading.Lock()
+_signers = {}  # private key text -> Vapid02
+_default_signer = None
+_jwts = {}  # (signer id, aud, sub) -> (exp, headers)
+
+
+def pool_stats():
+    with _sessions_lock:
+        return {'pool_size': POOL_SIZE, 'origins': sorted(_sessions)}
+
+
 # Helper to load VAPID keys if present
 def load_vapid_keys():
     # Return the public key (base64url string) and private key (PEM) as text.
@@ -21,74 +69,140 @@ def load_vapid_keys():
     return None, None
 
 
-def send_push(subscription_info, payload, vapid_private_key, vapid_claims):
-    # Debug: log input shapes (do not log secrets in production)
+class PushError(Exception):
+    """A failed delivery. status is the push service's HTTP status (None for
+    network errors, when no response came back) and retry_after its
+    Retry-After in seconds, if sent."""
+
+    def __init__(self, message, status=None, retry_after=None, invalid=False):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+        # the subscription itself is unusable (e.g. bad encryption keys)
+        self.invalid = invalid
+
+
+def parse_retry_after(value):
+    """Retry-After as seconds from now; it may be delta-seconds or a date."""
+    if not value:
+        return None
     try:
-        pk_type = type(vapid_private_key)
-        print('send_push: vapid_private_key type=', pk_type)
-        if isinstance(vapid_private_key, (bytes, bytearray)):
-            print('send_push: vapid_private_key bytes len=', len(vapid_private_key))
-        else:
-            print('send_push: vapid_private_key str len=', len(vapid_private_key) if vapid_private_key else 0)
-    except Exception:
+        return max(float(value), 0)
+    except ValueError:
         pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
 
+def vapid_signer(private_key=None):
+    """Return the parsed VAPID key, loading VAPID_PRIVATE_FILE when no key is
+    given. Each key is parsed once per process: as PEM, or failing that as a
+    raw base64url private scalar / DER. Returns None if no key is configured.
+    """
+    global _default_signer
+    if isinstance(private_key, Vapid01):
+        return private_key
+    if private_key is None:
+        if _default_signer is None:
+            _, private_key = load_vapid_keys()
+            if private_key:
+                _default_signer = vapid_signer(private_key)
+        return _default_signer
+    if isinstance(private_key, (bytes, bytearray)):
+        private_key = private_key.decode('utf-8')
+    with _vapid_lock:
+        signer = _signers.get(private_key)
+        if signer is None:
+            try:
+                signer = Vapid02.from_pem(private_key.encode('utf-8'))
+            except Exception:
+                signer = Vapid02.from_string(private_key)
+            _signers[private_key] = signer
+        return signer
+
+
+def vapid_headers(signer, vapid_claims, aud):
+    """Signed VAPID Authorization header for one push service audience,
+    reused until JWT_REFRESH_MARGIN seconds before it expires."""
+    key = (id(signer), aud, vapid_claims.get('sub'))
+    now = time.time()
+    with _vapid_lock:
+        cached = _jwts.get(key)
+        if cached and cached[0] - JWT_REFRESH_MARGIN > now:
+            return cached[1]
+    exp = int(now) + JWT_LIFETIME
+    headers = signer.sign(dict(vapid_claims, aud=aud, exp=exp))
+    with _vapid_lock:
+        _jwts[key] = (exp, headers)
+    return headers
+
+
+def _b64decode(value):
+    return base64.urlsafe_b64decode(value + '=' * (-len(value) % 4))
+
+
+def subscription_error(subscription):
+    """Why a browser subscription can't be pushed to, or None if it looks
+    usable: an http(s) endpoint and base64url p256dh (65 byte P-256 point)
+    and auth (16 byte) keys."""
+    if not isinstance(subscription, dict):
+        return 'subscription must be an object'
+    if urlsplit(subscription.get('endpoint') or '').scheme not in ('http', 'https'):
+        return 'endpoint must be an http(s) URL'
+    keys = subscription.get('keys')
+    if not isinstance(keys, dict):
+        return 'keys required'
+    for name, size in (('p256dh', 65), ('auth', 16)):
+        value = keys.get(name)
+        try:
+            if not isinstance(value, str) or len(_b64decode(value)) != size:
+                raise ValueError
+        except ValueError:
+            return f'keys.{name} must be {size} bytes, base64url encoded'
+    return None
+
+
+def _failure(subscription_info, ex, response=None, invalid=False):
     try:
-        endpoint = subscription_info.get('endpoint') if isinstance(subscription_info, dict) else 'unknown'
-        print('send_push: endpoint=', endpoint[:120])
-        keys = subscription_info.get('keys') if isinstance(subscription_info, dict) else None
-        if keys:
-            p256 = keys.get('p256dh')
-            auth = keys.get('auth')
-            print('send_push: p256dh len=', len(p256) if p256 else None, ' auth len=', len(auth) if auth else None)
+        err_text = response.text if response is not None else ''
     except Exception:
-        pass
+        err_text = ''
+    err_text = err_text or str(ex)
+    status = getattr(response, 'status_code', None)
+    retry_after = parse_retry_after(response.headers.get('Retry-After')) if response is not None else None
+    endpoint = subscription_info.get('endpoint') if isinstance(subscription_info, dict) else 'unknown'
+    print('WebPush failed:', (endpoint or '')[:120], status, err_text)
+    return False, PushError(err_text, status, retry_after, invalid)
 
+
+def send_push(subscription_info, payload, vapid_private_key, vapid_claims):
+    """Deliver one push. vapid_private_key may be a parsed key from
+    vapid_signer() or PEM text. Returns (ok, PushError or None): the push
+    service's answer, a network error, or a subscription that can't be
+    encrypted for (PushError.invalid). A bad VAPID key or payload affects
+    every subscription, so it raises instead."""
+    signer = vapid_signer(vapid_private_key)
+    headers = dict(vapid_headers(signer, vapid_claims, endpoint_origin(subscription_info)))
+    data = json.dumps(payload)
     try:
-        webpush(
-            subscription_info=subscription_info,
-            data=json.dumps(payload),
-            # pywebpush expects the private key as a PEM string
-            vapid_private_key=(vapid_private_key.decode('utf-8') if isinstance(vapid_private_key, (bytes, bytearray)) else vapid_private_key),
-            vapid_claims=vapid_claims,
-            ttl=60
+        response = WebPusher(subscription_info, requests_session=session_for(subscription_info)).send(
+            data,
+            headers,
+            ttl=60,
+            content_encoding='aes128gcm',
+            timeout=PUSH_TIMEOUT
         )
+        if response.status_code > 202:
+            raise WebPushException(
+                'Push failed: {} {}'.format(response.status_code, response.reason), response=response)
         return True, None
-    except Exception as ex:
-        # capture initial error text
-        try:
-            err_text = ex.response.text if hasattr(ex, 'response') and ex.response is not None else str(ex)
-        except Exception:
-            err_text = str(ex)
-        print('WebPush failed (initial attempt):', err_text)
-        # Try a fallback: some versions of the underlying crypto expect the private
-        # key as a base64url-encoded raw private scalar (32 bytes). Extract the
-        # scalar from the PEM and try again.
-        try:
-            if isinstance(vapid_private_key, (bytes, bytearray)):
-                pem = vapid_private_key
-            else:
-                pem = vapid_private_key.encode('utf-8')
-            priv = serialization.load_pem_private_key(pem, password=None)
-            priv_nums = priv.private_numbers().private_value
-            raw = priv_nums.to_bytes(32, 'big')
-            raw_b64 = base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
-            print('Retrying webpush with raw base64url private scalar (len=', len(raw), ')')
-            webpush(
-                subscription_info=subscription_info,
-                data=json.dumps(payload),
-                vapid_private_key=raw_b64,
-                vapid_claims=vapid_claims,
-                ttl=60
-            )
-            return True, None
-        except Exception as ex2:
-            try:
-                err2 = ex2.response.text if hasattr(ex2, 'response') and ex2.response is not None else str(ex2)
-            except Exception:
-                err2 = str(ex2)
-            print('WebPush failed (raw scalar attempt):', err2)
-            return False, err_text + ' || ' + err2
-    except Exception as e:
-        print('send_push unexpected error', e)
-        return False, str(e)
+    except requests.RequestException as ex:
+        return _failure(subscription_info, ex, getattr(ex, 'response', None))
+    except WebPushException as ex:
+        # without a response pywebpush refused the subscription before sending
+        return _failure(subscription_info, ex, ex.response, invalid=ex.response is None)
+    except (ValueError, TypeError) as ex:
+        # keys that don't decode to a usable P-256 point / auth secret
+        return _failure(subscription_info, ex, invalid=True)
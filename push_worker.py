@@ -0,0 +1,197 @@
+import json
+import os
+import signal
+import socket
+import threading
+import time
+import multiprocessing
+
+import redis
+
+import push_coalesce
+import push_db
+import push_fanout
+import push_jobs
+import push_utils
+
+# Push delivery worker, run standalone (python push_worker.py) so push
+# throughput scales apart from the web tier.
+#
+# Reliable queue: a worker takes a job with BLMOVE from push_queue onto its own
+# processing list and removes it only once the job is finished, so a job in
+# flight survives the worker dying. Every worker keeps a heartbeat key alive;
+# the reaper moves the processing list of any worker whose heartbeat has
+# expired back onto push_queue. A job that fails MAX_ATTEMPTS times goes to
+# the push_dead list instead of being retried forever. Delivery is therefore
+# at least once: a job interrupted mid fan-out is sent again in full.
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://127.0.0.1:6379/0')
+WORKERS = int(os.environ.get('PUSH_WORKERS', '2'))
+QUEUE_KEY = push_coalesce.QUEUE_KEY
+PROCESSING_PREFIX = 'push_processing:'
+HEARTBEAT_PREFIX = 'push_worker:'
+DEAD_KEY = 'push_dead'
+STATS_KEY = 'push_job_stats'
+HEARTBEAT_TTL = 30
+REAP_INTERVAL = 15
+MAX_ATTEMPTS = 3
+DEAD_MAX = 1000
+VAPID_CLAIMS = {'sub': 'mailto:admin@iamcalledned.ai'}
+
+
+def worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+
+
+def run_job(job, vapid_key, vapid_claims=VAPID_CLAIMS, r=None):
+    """Fan one job out to its subscriptions and return the stats. Progress of
+    jobs with a job_id is reported to push_jobs as it happens."""
+    job_id = job.get('job_id')
+    progress = push_jobs.JobProgress(r, job_id) if r is not None and job_id else None
+    subs = push_db.iter_subscriptions(deliverable=True, topic=job.get('topic'))
+    message = {k: job[k] for k in ('title', 'message', 'tag') if job.get(k)}
+    stats, _ = push_fanout.fan_out(subs, message, vapid_key, vapid_claims, progress=progress, keep_results=False)
+    stats['coalesced'] = job.get('coalesced', 1)
+    if progress is not None:
+        push_jobs.update(r, job_id, status='done', finished_at=time.time(), elapsed=stats['elapsed'])
+    return stats
+
+
+def reap(r):
+    """Return the jobs of workers whose heartbeat has expired to the queue.
+    Returns the number of jobs recovered."""
+    recovered = 0
+    for key in r.scan_iter(match=PROCESSING_PREFIX + '*'):
+        key = key.decode() if isinstance(key, bytes) else key
+        if r.exists(HEARTBEAT_PREFIX + key[len(PROCESSING_PREFIX):]):
+            continue
+        # LMOVE is atomic, so two reapers never recover the same job twice;
+        # orphans go to the consuming end so they are retried next
+        while r.lmove(key, QUEUE_KEY, 'RIGHT', 'RIGHT') is not None:
+            recovered += 1
+    if recovered:
+        print('push_worker recovered', recovered, 'orphaned jobs')
+    return recovered
+
+
+def _finish(r, processing, raw, job=None, error=None):
+    """Drop a job from the processing list. A failed one is queued again, or
+    dead-lettered after MAX_ATTEMPTS (or straight away if it isn't JSON)."""
+    pipe = r.pipeline(transaction=True)
+    pipe.lrem(processing, 1, raw)
+    if error is not None:
+        if job is None:
+            job = {'raw': raw.decode(errors='replace'), 'attempts': MAX_ATTEMPTS}
+        else:
+            job = dict(job, attempts=job.get('attempts', 0) + 1)
+        job['error'] = str(error)[:500]
+        if job['attempts'] >= MAX_ATTEMPTS:
+            pipe.lpush(DEAD_KEY, json.dumps(dict(job, failed_at=time.time())))
+            pipe.ltrim(DEAD_KEY, 0, DEAD_MAX - 1)
+        else:
+            pipe.lpush(QUEUE_KEY, json.dumps(job))
+    pipe.execute()
+    if error is not None:
+        status = 'failed' if job['attempts'] >= MAX_ATTEMPTS else 'retrying'
+        push_jobs.update(r, job.get('job_id'), status=status, attempts=job['attempts'], error=job['error'])
+
+
+def _heartbeat(r, key, done):
+    """Keep key alive until done is set, even while a long fan-out runs."""
+    while True:
+        try:
+            r.set(key, time.time(), ex=HEARTBEAT_TTL)
+        except redis.RedisError as e:
+            print('push_worker heartbeat error', e)
+        if done.wait(HEARTBEAT_TTL / 3):
+            return
+
+
+def run_worker(stop=None, r=None, wid=None, vapid_key=None):
+    """Process push_queue jobs until stop is set. The current job is always
+    finished before returning. Raises RuntimeError if no VAPID key is
+    configured, rather than failing every job."""
+    stop = stop or threading.Event()
+    r = r or redis.from_url(REDIS_URL)
+    wid = wid or worker_id()
+    processing = PROCESSING_PREFIX + wid
+    heartbeat = HEARTBEAT_PREFIX + wid
+    vapid_key = vapid_key or push_utils.vapid_signer()
+    if vapid_key is None:
+        raise RuntimeError('push_worker: VAPID private key not configured')
+    push_db.ensure_db()
+    done = threading.Event()
+    threading.Thread(target=_heartbeat, args=(r, heartbeat, done), daemon=True).start()
+    last_reap = 0
+    print('push_worker started', wid)
+    while not stop.is_set():
+        try:
+            if time.time() - last_reap > REAP_INTERVAL:
+                reap(r)
+                last_reap = time.time()
+            # turn coalescing buckets whose window has closed into jobs
+            push_coalesce.flush_due(r)
+            raw = r.blmove(QUEUE_KEY, processing, 1, 'RIGHT', 'LEFT')
+        except redis.RedisError as e:
+            print('push_worker redis error', e)
+            stop.wait(1)
+            continue
+        if raw is None:
+            continue
+        job = None
+        try:
+            job = json.loads(raw)
+            stats = run_job(job, vapid_key, r=r)
+            print('push_worker job done', json.dumps(stats))
+            # keep the most recent job stats for /scanner/push/stats
+            pipe = r.pipeline()
+            pipe.lpush(STATS_KEY, json.dumps(dict(stats, finished_at=time.time(), job_id=job.get('job_id'))))
+            pipe.ltrim(STATS_KEY, 0, 99)
+            pipe.execute()
+            _finish(r, processing, raw)
+        except Exception as e:
+            print('push_worker error', e)
+            _finish(r, processing, raw, job if isinstance(job, dict) else None, e)
+    done.set()
+    r.delete(heartbeat)
+    print('push_worker stopped', wid)
+
+
+def start_worker_thread():
+    """Run a worker on a daemon thread (used by the Flask dev server)."""
+    t = threading.Thread(target=run_worker, name='push-worker', daemon=True)
+    t.start()
+    return t
+
+
+def _process_main():
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    # the parent handles Ctrl-C and forwards it as SIGTERM
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    run_worker(stop)
+
+
+def main(workers=WORKERS):
+    """Run `workers` worker processes, restarting any that die, until SIGTERM
+    or SIGINT; then let each finish its current job and exit."""
+    if push_utils.vapid_signer() is None:
+        raise SystemExit('push_worker: VAPID private key not configured')
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+    procs = []
+    while not stop.is_set():
+        procs = [p for p in procs if p.is_alive()]
+        while len(procs) < workers:
+            p = multiprocessing.Process(target=_process_main, name='push-worker')
+            p.start()
+            procs.append(p)
+        stop.wait(1)
+    for p in procs:
+        p.terminate()  # SIGTERM: finish the current job, then exit
+    for p in procs:
+        p.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+import os
+import threading
+import time
+
+import call_index
+import meta_store
+import review_db
+
+# Writes approved transcript edits back into the clean archive through
+# meta_store, so each sidecar is rewritten atomically under its lock and the
+# batch shares one fsync pass. Afterwards the listings are refreshed in one
+# go: one call_index transaction for every call and one review_db update for
+# every edit (meta_store invalidates meta_cache for the whole batch).
+BATCH_MAX = 500
+
+# One batch at a time per process; the files themselves are safe either way.
+_apply_lock = threading.Lock()
+
+
+def sidecar_path(edit):
+    if edit["feed"] not in call_index.FEEDS:
+        raise ValueError(f"unknown feed {edit['feed']!r}")
+    stem = os.path.splitext(os.path.basename(edit["filename"]))[0]
+    return call_index.feed_dir(edit["feed"]) / f"{stem}.json"
+
+
+def _set_edit(edit):
+    def fn(meta):
+        meta["edited_transcript"] = edit["transcript"]
+        meta["edited"] = True
+        meta["edit_id"] = edit["id"]
+        meta["edited_at"] = time.time()
+        return meta
+    return fn
+
+
+def apply_approved(edit_ids=None, feed=None, limit=BATCH_MAX):
+    """Apply approved, not yet applied edits (optionally just edit_ids, or
+    one feed's), oldest first so the newest edit of a call wins. Returns
+    {'applied': [ids], 'failed': [{'id', 'error'}]}."""
+    with _apply_lock:
+        edits = review_db.unapplied(edit_ids, feed, min(limit or BATCH_MAX, BATCH_MAX))
+        applied, failed, updates = [], [], []
+        for edit in edits:
+            try:
+                path = sidecar_path(edit)
+                if not path.exists():
+                    raise FileNotFoundError(f"{path} not found")
+            except Exception as e:
+                failed.append((edit, e))
+                continue
+            updates.append((edit, path))
+        try:
+            meta_store.update_many([(path, _set_edit(edit)) for edit, path in updates])
+            applied = updates
+        except Exception:
+            # find the edit(s) that failed; the rest still go in
+            for edit, path in updates:
+                try:
+                    meta_store.update_json(path, _set_edit(edit))
+                    applied.append((edit, path))
+                except Exception as e:
+                    failed.append((edit, e))
+        for edit, e in failed:
+            print("apply edit failed", edit["id"], edit["filename"], e)
+        if applied:
+            call_index.index_calls({(edit["feed"], path.stem) for edit, path in applied})
+        review_db.mark_applied([edit["id"] for edit, _ in applied], [(edit["id"], e) for edit, e in failed])
+    return {"applied": [edit["id"] for edit, _ in applied],
+            "failed": [{"id": edit["id"], "error": str(e)} for edit, e in failed]}
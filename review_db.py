@@ -0,0 +1,195 @@
+import os
+import sqlite3
+import time
+
+import sqlite_db
+
+# Transcript edits waiting for a moderator. An edit is a row that points at
+# the call in the clean archive (feed + filename); nothing is copied. With
+# REVIEW_HARDLINK=1 the WAV is also hardlinked into REVIEW_DIR for tools that
+# want the files side by side, which costs no extra disk space.
+DB_PATH = os.environ.get('REVIEW_DB', os.path.join(os.path.dirname(__file__), 'review.sqlite3'))
+REVIEW_DIR = os.environ.get('REVIEW_DIR', '/home/ned/scanner_archive/review')
+HARDLINK = os.environ.get('REVIEW_HARDLINK', '0') == '1'
+STATUSES = ('pending', 'approved', 'rejected', 'superseded')
+PAGE_MAX = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS edits (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    feed TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    transcript TEXT NOT NULL,
+    original_transcript TEXT,
+    status TEXT NOT NULL DEFAULT 'pending',
+    submitted_at REAL NOT NULL,
+    submitted_by TEXT,
+    reviewed_at REAL,
+    reviewer TEXT,
+    note TEXT,
+    link_path TEXT,
+    applied_at REAL,
+    apply_error TEXT
+);
+-- the moderator queue: newest first within a status, across feeds or in one
+CREATE INDEX IF NOT EXISTS edits_status_id ON edits (status, id);
+CREATE INDEX IF NOT EXISTS edits_status_feed ON edits (status, feed, id);
+CREATE INDEX IF NOT EXISTS edits_call ON edits (feed, filename, status);
+-- approved edits still to be written to the archive
+CREATE INDEX IF NOT EXISTS edits_unapplied ON edits (status, id) WHERE status = 'approved' AND applied_at IS NULL;
+"""
+
+FIELDS = ('id', 'feed', 'filename', 'transcript', 'original_transcript', 'status', 'submitted_at',
+          'submitted_by', 'reviewed_at', 'reviewer', 'note', 'link_path', 'applied_at', 'apply_error')
+
+def _ensure_schema(conn):
+    conn.executescript(SCHEMA)
+    conn.commit()
+
+
+_db = sqlite_db.ThreadLocalDB(lambda: DB_PATH, _ensure_schema, row_factory=sqlite3.Row)
+
+
+def get_conn():
+    return _db.conn()
+
+
+def _edit(row):
+    return {k: row[k] for k in FIELDS} if row is not None else None
+
+
+def _link(wav_path):
+    """Hardlink the WAV into REVIEW_DIR if enabled. Never copies: on a
+    different filesystem the edit simply has no link."""
+    if not HARDLINK:
+        return None
+    dst = os.path.join(REVIEW_DIR, os.path.basename(wav_path))
+    try:
+        os.makedirs(REVIEW_DIR, exist_ok=True)
+        if not os.path.exists(dst):
+            os.link(wav_path, dst)
+        return dst
+    except OSError as e:
+        print('review hardlink failed', wav_path, e)
+        return None
+
+
+def submit(feed, filename, transcript, original_transcript=None, submitted_by=None, wav_path=None):
+    """Queue an edit of one call and return its id. Pending edits of the same
+    call are superseded by the new one."""
+    link_path = _link(wav_path) if wav_path else None
+    conn = get_conn()
+    with conn:
+        conn.execute("UPDATE edits SET status = 'superseded', reviewed_at = ? "
+                     "WHERE feed = ? AND filename = ? AND status = 'pending'", (time.time(), feed, filename))
+        cur = conn.execute('INSERT INTO edits (feed, filename, transcript, original_transcript, submitted_at, '
+                           'submitted_by, link_path) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                           (feed, filename, transcript, original_transcript, time.time(), submitted_by, link_path))
+    return cur.lastrowid
+
+
+def get_edit(edit_id):
+    return _edit(get_conn().execute('SELECT * FROM edits WHERE id = ?', (edit_id,)).fetchone())
+
+
+def list_edits(status='pending', feed=None, limit=50, before=None):
+    """Edits with the given status (and feed), newest first. Pass the last
+    id of a page as ``before`` to get the next one."""
+    sql = 'SELECT * FROM edits WHERE status = ?'
+    params = [status]
+    if feed:
+        sql += ' AND feed = ?'
+        params.append(feed)
+    if before:
+        sql += ' AND id < ?'
+        params.append(before)
+    sql += ' ORDER BY id DESC LIMIT ?'
+    params.append(min(limit, PAGE_MAX))
+    return [_edit(r) for r in get_conn().execute(sql, params)]
+
+
+def counts():
+    """{status: {feed: n}} for the whole queue."""
+    out = {}
+    for row in get_conn().execute('SELECT status, feed, COUNT(*) AS n FROM edits GROUP BY status, feed'):
+        out.setdefault(row['status'], {})[row['feed']] = row['n']
+    return out
+
+
+def has_pending(feed, filename):
+    """Whether the call has an edit awaiting review."""
+    return get_conn().execute("SELECT 1 FROM edits WHERE feed = ? AND filename = ? AND status = 'pending' LIMIT 1",
+                              (feed, filename)).fetchone() is not None
+
+
+def pending_edit(feed, filename):
+    """The call's edit awaiting review, or None."""
+    return _edit(get_conn().execute("SELECT * FROM edits WHERE feed = ? AND filename = ? AND status = 'pending' "
+                                    'ORDER BY id DESC LIMIT 1', (feed, filename)).fetchone())
+
+
+def edit_calls(edit_ids):
+    """The (feed, filename) pairs the given edits belong to."""
+    edit_ids = [int(i) for i in edit_ids]
+    if not edit_ids:
+        return []
+    return [(r['feed'], r['filename']) for r in get_conn().execute(
+        f"SELECT DISTINCT feed, filename FROM edits WHERE id IN ({', '.join('?' * len(edit_ids))})", edit_ids)]
+
+
+def set_status(edit_ids, status, reviewer=None, note=None):
+    """Move pending edits to approved or rejected. Returns the ids that were
+    still pending (and so changed); others are left alone."""
+    if status not in ('approved', 'rejected'):
+        raise ValueError(f"unknown review status {status!r}")
+    changed, links = [], []
+    conn = get_conn()
+    with conn:
+        now = time.time()
+        for edit_id in edit_ids:
+            cur = conn.execute("UPDATE edits SET status = ?, reviewed_at = ?, reviewer = ?, note = ? "
+                               "WHERE id = ? AND status = 'pending'", (status, now, reviewer, note, int(edit_id)))
+            if cur.rowcount:
+                changed.append(int(edit_id))
+        if changed:
+            links = [r['link_path'] for r in conn.execute(
+                f"SELECT link_path FROM edits WHERE link_path IS NOT NULL AND id IN ({', '.join('?' * len(changed))})",
+                changed)]
+    for path in links:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+    return changed
+
+
+def unapplied(edit_ids=None, feed=None, limit=None):
+    """Approved edits not yet written to the archive, oldest first."""
+    sql = "SELECT * FROM edits WHERE status = 'approved' AND applied_at IS NULL"
+    params = []
+    if edit_ids is not None:
+        edit_ids = [int(i) for i in edit_ids]
+        if not edit_ids:
+            return []
+        sql += f" AND id IN ({', '.join('?' * len(edit_ids))})"
+        params.extend(edit_ids)
+    if feed:
+        sql += ' AND feed = ?'
+        params.append(feed)
+    sql += ' ORDER BY id'
+    if limit:
+        sql += ' LIMIT ?'
+        params.append(limit)
+    return [_edit(r) for r in get_conn().execute(sql, params)]
+
+
+def mark_applied(applied, failed=()):
+    """Record a batch's outcome in one transaction: ``applied`` ids were
+    written to the archive, ``failed`` is (id, error) pairs left to retry."""
+    now = time.time()
+    conn = get_conn()
+    with conn:
+        conn.executemany('UPDATE edits SET applied_at = ?, apply_error = NULL WHERE id = ?',
+                         [(now, i) for i in applied])
+        conn.executemany('UPDATE edits SET apply_error = ? WHERE id = ?',
+                         [(str(err)[:500], i) for i, err in failed])
@@ -1,84 +1,183 @@
-from flask import Blueprint, jsonify, send_from_directory, abort
+from flask import Blueprint, jsonify, abort, request
 from pathlib import Path
-import json
+import datetime
+import sqlite3
+import audio_files
+import call_index
 
 api_scanner_bp = Blueprint("api_scanner", __name__)
 ARCHIVE_BASE = Path("/home/ned/scanner_archive/clean")
 
-def find_file(filename):
-    for sub in ["pd", "fd"]:
-        f = ARCHIVE_BASE / sub / filename
-        if f.exists():
-            return f
-    return None
+CALL_FIELDS = ("id", "feed", "audio", "transcript", "filename", "edited", "metadata")
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+DEFAULT_SEARCH_SIZE = 20
+
+
+def _call_entry(row, fields=CALL_FIELDS):
+    call_id = row["stem"].replace("rec_", "")
+    entry = {
+        "id": call_id,
+        "feed": row["feed"],
+        "audio": f"/api/audio/{row['filename']}",
+        "transcript": "",
+        "filename": row["filename"],
+    }
+
+    if row["has_json"]:
+        # Choose transcript
+        if row["edited"]:
+            entry["transcript"] = row["edited_transcript"]
+            entry["edited"] = True
+        else:
+            entry["transcript"] = row["transcript"] if row["transcript"] is not None else ""
+            entry["edited"] = False
+
+        if "metadata" in fields:
+            entry["metadata"] = call_index.row_metadata(row)
+
+    return {k: v for k, v in entry.items() if k in fields}
+
+
+def _parse_cursor(value):
+    """Cursors look like `<call id>` or `<call id>:<feed>`."""
+    if not value:
+        return None
+    call_id, _, feed = value.partition(":")
+    return f"rec_{call_id}", feed or None
+
+
+def _cursor(row):
+    return f"{row['stem'].replace('rec_', '')}:{row['feed']}"
+
 
 @api_scanner_bp.route("/api/calls")
 def list_calls():
-    calls = []
-    for sub in ["pd", "fd"]:
-        for wav in sorted((ARCHIVE_BASE / sub).glob("*.wav"), reverse=True):
-            base = wav.stem
-            json_path = wav.with_suffix(".json")
-            call_id = base.replace("rec_", "")
-            entry = {
-                "id": call_id,
-                "feed": sub,
-                "audio": f"/api/audio/{wav.name}",
-                "transcript": "",  # will set below
-                "filename": wav.name,
-            }
-
-            if json_path.exists():
-                try:
-                    with open(json_path) as f:
-                        meta = json.load(f)
-
-                        # Choose transcript
-                        if meta.get("edited") and meta.get("edited_transcript"):
-                            entry["transcript"] = meta["edited_transcript"]
-                            entry["edited"] = True
-                        else:
-                            entry["transcript"] = meta.get("transcript", "")
-                            entry["edited"] = False
-
-                        entry["metadata"] = meta
-
-                except Exception as e:
-                    print(f"[WARN] Skipping {json_path.name}: {e}")
-
-            calls.append(entry)
-
-    return jsonify(calls)
+    """List calls, newest first.
+
+    Query args: `feed` (pd/fd, default both), `fields` (comma separated subset
+    of CALL_FIELDS), and for paging `limit` plus a `before` or `after` cursor.
+    Without paging args the whole archive is returned as a bare array, as
+    before; with them the response is `{"calls", "cursors", "has_more"}`.
+    """
+    feeds = ["pd", "fd"]
+    if request.args.get("feed"):
+        if request.args["feed"] not in feeds:
+            return jsonify({"error": "Invalid feed"}), 400
+        feeds = [request.args["feed"]]
+
+    fields = CALL_FIELDS
+    if request.args.get("fields"):
+        fields = tuple(f for f in request.args["fields"].split(",") if f in CALL_FIELDS)
+        if not fields:
+            return jsonify({"error": "No valid fields requested"}), 400
+    columns = "*" if "metadata" in fields else \
+        "feed, filename, stem, has_json, transcript, edited_transcript, edited"
+
+    for sub in feeds:
+        call_index.refresh(sub, ARCHIVE_BASE / sub)
+
+    paged = any(k in request.args for k in ("limit", "before", "after"))
+    if not paged:
+        calls = []
+        for sub in feeds:
+            calls.extend(_call_entry(row, fields) for row in call_index.query_calls(sub))
+        return jsonify(calls)
+
+    try:
+        limit = min(max(int(request.args.get("limit", DEFAULT_PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+    except ValueError:
+        return jsonify({"error": "Invalid limit"}), 400
+    before = _parse_cursor(request.args.get("before"))
+    after = _parse_cursor(request.args.get("after"))
+    if before and after:
+        return jsonify({"error": "Use either before or after, not both"}), 400
+
+    rows = call_index.page_calls(feeds, limit, before=before, after=after, columns=columns)
+    has_more = len(rows) > limit
+    if has_more:
+        # the extra row is the one furthest from the cursor
+        rows = rows[1:] if after else rows[:limit]
+
+    return jsonify({
+        "calls": [_call_entry(row, fields) for row in rows],
+        "cursors": {
+            "before": _cursor(rows[-1]) if rows else None,
+            "after": _cursor(rows[0]) if rows else (request.args.get("after") or None),
+        },
+        "has_more": has_more,
+    })
+
+@api_scanner_bp.route("/api/search")
+def search_calls():
+    """Full-text search over the transcript variants, best match first.
+
+    Query args: `q` (words, all must match; the last may be a prefix), `feed`
+    (pd/fd, default both), an inclusive `from` / `to` range of YYYY-MM-DD days,
+    and `limit` / `page` for paging. Each hit is a call entry plus a `snippet`
+    with the matched words in [brackets].
+    """
+    match = call_index.fts_query(request.args.get("q", ""))
+    if not match:
+        return jsonify({"error": "q required"}), 400
+
+    feeds = ["pd", "fd"]
+    if request.args.get("feed"):
+        if request.args["feed"] not in feeds:
+            return jsonify({"error": "Invalid feed"}), 400
+        feeds = [request.args["feed"]]
+
+    try:
+        first = request.args.get("from") and datetime.date.fromisoformat(request.args["from"]).isoformat()
+        last = request.args.get("to") and datetime.date.fromisoformat(request.args["to"]).isoformat()
+    except ValueError:
+        return jsonify({"error": "Invalid date, use YYYY-MM-DD"}), 400
+    try:
+        limit = min(max(int(request.args.get("limit", DEFAULT_SEARCH_SIZE)), 1), MAX_PAGE_SIZE)
+        page = max(int(request.args.get("page", 1)), 1)
+    except ValueError:
+        return jsonify({"error": "Invalid limit or page"}), 400
+
+    for sub in feeds:
+        call_index.refresh(sub, ARCHIVE_BASE / sub)
+    try:
+        rows = call_index.search_calls(match, feeds, first or None, last or None,
+                                       limit=limit, offset=(page - 1) * limit)
+    except sqlite3.OperationalError as e:
+        return jsonify({"error": f"Invalid query: {e}"}), 400
+
+    hits = []
+    for row in rows[:limit]:
+        entry = _call_entry(row, ("id", "feed", "audio", "transcript", "filename", "edited"))
+        entry["snippet"] = row["snippet"]
+        hits.append(entry)
+    return jsonify({"results": hits, "page": page, "has_more": len(rows) > limit})
 
 @api_scanner_bp.route("/api/call/<call_id>")
 def get_call_details(call_id):
-    base = f"rec_{call_id}"
-    wav = find_file(f"{base}.wav")
-    if not wav:
+    filename = f"rec_{call_id}.wav"
+    for sub in ["pd", "fd"]:
+        call_index.refresh(sub, ARCHIVE_BASE / sub)
+    row = call_index.get_call(filename)
+    if not row:
         return abort(404, description="Call not found")
-    txt = wav.with_suffix(".txt")
-    json_path = wav.with_suffix(".json")
 
     data = {
         "id": call_id,
-        "audio": f"/api/audio/{wav.name}",
-        "filename": wav.name,
-        "transcript": txt.read_text() if txt.exists() else "",
-        "metadata": {}
+        "audio": f"/api/audio/{filename}",
+        "filename": filename,
+        "transcript": row["txt_transcript"] or "",
+        "metadata": call_index.row_metadata(row) or {}
     }
 
-    if json_path.exists():
-        try:
-            data["metadata"] = json.loads(json_path.read_text())
-        except:
-            pass
-
     return jsonify(data)
 
 @api_scanner_bp.route("/api/audio/<filename>")
 def get_audio(filename):
-    f = find_file(filename)
+    f = audio_files.find_audio(filename)
     if not f:
         return abort(404)
-    return send_from_directory(f.parent, f.name)
-
+    try:
+        return audio_files.send_call_audio(f)
+    except FileNotFoundError:
+        return abort(404)
@@ -4,6 +4,8 @@ import json
 from . import routes_scanner as scanner_routes
 import push_db
 import push_utils
+import push_coalesce
+import push_jobs
 import redis
 
 push_bp = Blueprint('push', __name__)
@@ -27,11 +29,22 @@ def get_vapid_public():
 
 @push_bp.route('/scanner/push/subscribe', methods=['POST'])
 def subscribe():
+    """Store a push subscription.
+
+    The body is either the browser's subscription JSON, which receives every
+    notification, or {"subscription": {...}, "topics": {"feeds": ["pd"],
+    "keywords": [...], "units": [...]}} to receive only matching ones.
+    """
     data = request.get_json()
     if not data:
         return jsonify({'error': 'invalid json'}), 400
-    push_db.save_subscription(data)
-    return jsonify({'success': True})
+    subscription = data.get('subscription', data)
+    error = push_utils.subscription_error(subscription)
+    if error:
+        return jsonify({'error': error}), 400
+    push_db.save_subscription(subscription, data.get('topics'))
+    topics = push_db.get_topics(subscription['endpoint'])
+    return jsonify({'success': True, 'topics': [{'kind': k, 'value': v} for k, v in topics]})
 
 
 @push_bp.route('/scanner/push/unsubscribe', methods=['POST'])
@@ -42,38 +55,59 @@ def unsubscribe():
     return jsonify({'success': True})
 
 
+def _job_topic(data, message):
+    """Targeting for a send request: optional `feed`, `keywords` (default:
+    the message's words) and `units`."""
+    return push_db.job_topic(data.get('feed'), message, data.get('keywords'), data.get('units'))
+
+
 @push_bp.route('/scanner/push/send', methods=['POST'])
 def send_push():
+    """Queue a push. Jobs for the same topic arriving within
+    PUSH_COALESCE_WINDOW seconds are merged into one digest notification;
+    pass "immediate": true to skip that. Returns the job id to poll at
+    /scanner/push/jobs/<id>."""
     data = request.get_json() or {}
-    message = data.get('message', 'Test push')
-    # push job to redis list
-    redis_client.lpush('push_queue', json.dumps({'message': message}))
-    return jsonify({'queued': True})
+    return _queue_job(data, immediate=bool(data.get('immediate')))
 
 
 @push_bp.route('/scanner/push/send_now', methods=['POST'])
 def send_push_now():
-    """Send a push to all stored subscriptions immediately (useful for testing).
+    """Queue a push to every matching subscription, skipping coalescing.
 
-    WARNING: this will attempt to send to every subscription in the DB and will
-    perform network calls synchronously. Intended for local testing only.
+    The push workers do the fan-out; this returns a job id straight away
+    rather than waiting for every subscription to be sent to.
     """
     data = request.get_json() or {}
-    message = data.get('message', 'Test push')
-    vapid_pub, vapid_priv = push_utils.load_vapid_keys()
-    if not vapid_priv:
+    if not push_utils.vapid_signer():
         return jsonify({'error': 'VAPID private key not configured'}), 500
-    vapid_claims = {'sub': 'mailto:admin@iamcalledned.ai'}
-    results = []
-    subs = push_db.list_subscriptions()
-    for s in subs:
-        try:
-            ok, err = push_utils.send_push(s, {'message': message}, vapid_priv, vapid_claims)
-            entry = {'endpoint': s.get('endpoint'), 'ok': bool(ok)}
-            if err:
-                entry['error'] = str(err)
-            results.append(entry)
-        except Exception as e:
-            results.append({'endpoint': s.get('endpoint'), 'ok': False, 'error': str(e)})
-    return jsonify({'sent': sum(1 for r in results if r.get('ok')), 'results': results})
+    return _queue_job(data, immediate=True)
+
+
+def _queue_job(data, immediate):
+    message = data.get('message', 'Test push')
+    # the worker only sends it to subscriptions whose topics match
+    job = {'message': message, 'topic': _job_topic(data, message)}
+    job_id = push_jobs.create(redis_client, job)
+    push_coalesce.enqueue(redis_client, job, window=0 if immediate else None)
+    return jsonify({'queued': True, 'job_id': job_id,
+                    'status_url': f"/scanner/push/jobs/{job_id}"}), 202
+
+
+@push_bp.route('/scanner/push/jobs/<job_id>')
+def push_job_status(job_id):
+    """Live progress of a queued push job: status, total, sent, failed,
+    removed and backoff counts, and send latency percentiles."""
+    job = push_jobs.get(redis_client, job_id)
+    if job is None:
+        return jsonify({'error': 'unknown job'}), 404
+    return jsonify(job)
+
 
+@push_bp.route('/scanner/push/stats')
+def push_stats():
+    """Completion stats of the most recent push_queue jobs, newest first."""
+    limit = min(int(request.args.get('limit', 20)), 100)
+    items = redis_client.lrange('push_job_stats', 0, limit - 1)
+    return jsonify({'jobs': [json.loads(i) for i in items], 'pools': push_utils.pool_stats(),
+                    'subscriptions': push_db.delivery_summary()})
@@ -1,135 +1,126 @@
-from flask import Blueprint, render_template, send_from_directory, request, jsonify, redirect
+from flask import Blueprint, Response, render_template, request, jsonify, redirect
 from pathlib import Path
 import datetime
 import json
 from collections import defaultdict
 from werkzeug.utils import secure_filename
-import shutil
 import os
-import time
-import threading
+import queue
 import uuid
+import audio_files
+import call_index
+import call_stream
+import meta_cache
+import meta_store
+import presence
+import review_apply
+import review_db
+import redis
 
 scanner_bp = Blueprint("scanner", __name__)
 LOGIN_PROCESS_URL = os.environ.get('LOGIN_PROCESS_URL', 'http://127.0.0.1:8010/api/login')
 ARCHIVE_DIR = "/home/ned/scanner_archive/clean"
-PD_DIR = Path("/home/ned/scanner_archive/clean/pd")
-REVIEW_DIR = Path("/home/ned/scanner_archive/review")
 SEGMENT_DIR = Path("/home/ned/scanner_archive/segmentation/processed")
 CALLS_PER_PAGE = 10
+STREAM_KEEPALIVE = 15  # seconds between SSE comments on an idle stream
+SEGMENT_LABELS_MAX = 1000  # labels per /scanner/submit_segment_labels request
 
-# Simple in-memory active user registry. Key: client_id -> {last_seen, ip, ua, page}
-ACTIVE_USERS = {}
-ACTIVE_LOCK = threading.Lock()
-ACTIVE_TIMEOUT = 120  # seconds considered "active"
 
 
 
-def load_calls(directory, feed="pd", filter_today=False):
-    calls = []
-    today = datetime.date.today()
-
-    for wav in sorted(Path(directory).glob("*.wav"), reverse=True):
-        base = wav.stem
-        txt = wav.with_suffix(".txt")
-        json_path = wav.with_suffix(".json")
-
-        try:
-            date_str = base.split("_")[1]
-            call_date = datetime.datetime.strptime(date_str, "%Y-%m-%d").date()
-        except Exception:
-            call_date = None
-
-        if filter_today and call_date != today:
-            continue
-
-        timestamp = base.replace("rec_", "").replace("_", " ")
-        try:
-            dt = datetime.datetime.strptime(base.replace("rec_", ""), "%Y-%m-%d_%H-%M-%S")
-            timestamp_human = dt.strftime("%b %d, %I:%M %p")
-        except Exception:
-            timestamp_human = timestamp
-
-        transcript = "(no transcript)"
-        edit_pending = False
-        edited_transcript = ""
-
-        if json_path.exists():
-            try:
-                with open(json_path) as f:
-                    data = json.load(f)
-
-                if data.get("edited") and data.get("edited_transcript"):
-                    transcript = data["edited_transcript"]
-                    edit_pending = False
-                elif "edited_transcript" in data:
-                    transcript = data["edited_transcript"]
-                    edit_pending = True
-                else:
-                    transcript = data.get("transcript", transcript)
-
-                calls.append({
-                    "file": wav.name,
-                    "path": f"/scanner/audio/{wav.name}",
-                    "transcript": data.get("transcript", transcript),
-                    "edited_transcript": data.get("edited_transcript", ""),
-                    "enhanced_transcript": data.get("enhanced_transcript", ""),
-                    "edit_pending": edit_pending,
-                    "timestamp": timestamp,
-                    "timestamp_human": timestamp_human,
-                    "feed": feed,
-                    "metadata": data
-                })
-            except Exception as e:
-                print(f"[!] Failed to load JSON for {base}: {e}")
-
-    return calls
-
-
-def load_archive(directory):
-    archive = {}
-    for wav in sorted(Path(directory).glob("*.wav"), reverse=True):
-        base = wav.stem
-        txt = wav.with_suffix(".txt")
-        try:
-            date_str = base.split("_")[1]
-            call_date = datetime.datetime.strptime(date_str, "%Y-%m-%d").date()
-            day_key = call_date.strftime("%Y-%m-%d")
-        except Exception:
-            day_key = "unknown"
-
-        timestamp = base.replace("rec_", "").replace("_", " ")
-        try:
-            dt = datetime.datetime.strptime(base.replace("rec_", ""), "%Y-%m-%d_%H-%M-%S")
-            timestamp_human = dt.strftime("%b %d, %I:%M %p")
-        except Exception:
-            timestamp_human = timestamp
-
-        data = {
-            "file": wav.name,
-            "path": f"/scanner/audio/{wav.name}",
-            "transcript": txt.read_text() if txt.exists() else "(no transcript)",
-            "timestamp": timestamp,
-            "timestamp_human": timestamp_human
-        }
-        archive.setdefault(day_key, []).append(data)
-    return dict(sorted(archive.items(), reverse=True))
+def _timestamps(stem):
+    timestamp = stem.replace("rec_", "").replace("_", " ")
+    try:
+        dt = datetime.datetime.strptime(stem.replace("rec_", ""), "%Y-%m-%d_%H-%M-%S")
+        timestamp_human = dt.strftime("%b %d, %I:%M %p")
+    except Exception:
+        timestamp_human = timestamp
+    return timestamp, timestamp_human
+
+
+def _call_record(row):
+    data = call_index.row_metadata(row) or {}
+    timestamp, timestamp_human = _timestamps(row["stem"])
+
+    transcript = "(no transcript)"
+    if data.get("edited") and data.get("edited_transcript"):
+        transcript = data["edited_transcript"]
+    elif "edited_transcript" in data:
+        transcript = data["edited_transcript"]
+    edited_transcript = data.get("edited_transcript", "")
+    if row["edit_pending"]:
+        # the queued edit lives in review_db until it is applied
+        pending = review_db.pending_edit(row["feed"], row["filename"])
+        if pending is not None:
+            edited_transcript = pending["transcript"]
+
+    return {
+        "file": row["filename"],
+        "path": f"/scanner/audio/{row['filename']}",
+        "transcript": data.get("transcript", transcript),
+        "edited_transcript": edited_transcript,
+        "enhanced_transcript": data.get("enhanced_transcript", ""),
+        "edit_pending": bool(row["edit_pending"]),
+        "timestamp": timestamp,
+        "timestamp_human": timestamp_human,
+        "feed": row["feed"],
+        "metadata": data
+    }
+
+
+def load_calls(directory, feed="pd", filter_today=False, limit=None, offset=0):
+    call_index.refresh(feed, directory)
+    day = datetime.date.today().strftime("%Y-%m-%d") if filter_today else None
+    rows = call_index.query_calls(feed, day=day, limit=limit, offset=offset, require_json=True)
+    return [_call_record(row) for row in rows]
+
+
+# New calls for the live pages, detected once per process and fanned out to
+# every /scanner/stream listener.
+CALL_STREAM = call_stream.CallStream(_call_record)
+
+
+def _archive_entry(row):
+    timestamp, timestamp_human = _timestamps(row["stem"])
+    return {
+        "file": row["filename"],
+        "path": f"/scanner/audio/{row['filename']}",
+        "transcript": row["txt_transcript"] if row["txt_transcript"] is not None else "(no transcript)",
+        "timestamp": timestamp,
+        "timestamp_human": timestamp_human
+    }
+
+
+def load_archive_days(directory):
+    """Day keys and call counts for a feed, newest day first, without reading
+    any calls."""
+    feed = Path(directory).name
+    call_index.refresh(feed, directory)
+    return dict(call_index.day_counts(feed))
+
+
+def load_archive_page(directory, day, page=1):
+    """One page of one day's calls; only these rows' transcripts are read."""
+    feed = Path(directory).name
+    call_index.refresh(feed, directory)
+    rows = call_index.query_calls(
+        feed, day=day, limit=CALLS_PER_PAGE, offset=max(page - 1, 0) * CALLS_PER_PAGE,
+        columns="filename, stem, txt_transcript")
+    return [_archive_entry(row) for row in rows]
 
 
 @scanner_bp.route("/scanner/segments")
 def scanner_segments():
+    call_index.refresh(call_index.SEGMENT_FEED, SEGMENT_DIR)
     calls = []
-    for wav in sorted(SEGMENT_DIR.glob("*.wav"), reverse=True):
-        base = wav.stem
-        json_path = wav.with_suffix(".json")
+    for row in call_index.query_calls(call_index.SEGMENT_FEED):
         transcript = "(no transcript)"
         speaker = ""
-        timestamp_human = wav.stem.replace("_", " ")
+        timestamp_human = row["stem"].replace("_", " ")
 
-        if json_path.exists():
+        data = call_index.row_metadata(row)
+        if data is not None:
             try:
-                with open(json_path) as f:
-                    data = json.load(f)
                 transcript = data.get("transcript", transcript)
                 speaker = data.get("speaker", "")
                 timestamp_human = datetime.datetime.fromisoformat(data.get("timestamp")).strftime("%b %d, %I:%M %p")
@@ -137,8 +128,8 @@ def scanner_segments():
                 pass
 
         calls.append({
-            "file": wav.name,
-            "path": f"/scanner/audio/{wav.name}",
+            "file": row["filename"],
+            "path": f"/scanner/audio/{row['filename']}",
             "transcript": transcript,
             "timestamp_human": timestamp_human,
             "speaker": speaker
@@ -148,24 +139,28 @@ def scanner_segments():
 
 @scanner_bp.route("/scanner_pd")
 def scanner_pd():
-    calls = load_calls(f"{ARCHIVE_DIR}/pd", filter_today=True)
     page = int(request.args.get("page", 1))
-    start = (page - 1) * CALLS_PER_PAGE
-    end = start + CALLS_PER_PAGE
+    start = max(page - 1, 0) * CALLS_PER_PAGE
     if request.headers.get("Accept") == "application/json":
-        return jsonify({"calls": calls[start:end]})
-    return render_template("scanner_pd.html", calls=calls[:CALLS_PER_PAGE])
+        calls = load_calls(f"{ARCHIVE_DIR}/pd", filter_today=True, limit=CALLS_PER_PAGE, offset=start)
+        return jsonify({"calls": calls})
+    # the live stream resumes from here, so calls landing after this render
+    # are replayed rather than missed
+    last_seq = call_index.max_seq()
+    calls = load_calls(f"{ARCHIVE_DIR}/pd", filter_today=True, limit=CALLS_PER_PAGE)
+    return render_template("scanner_pd.html", calls=calls, last_seq=last_seq)
 
 
 @scanner_bp.route("/scanner_fire")
 def scanner_fire():
-    calls = load_calls(f"{ARCHIVE_DIR}/fd", feed="fd", filter_today=True)
     page = int(request.args.get("page", 1))
-    start = (page - 1) * CALLS_PER_PAGE
-    end = start + CALLS_PER_PAGE
+    start = max(page - 1, 0) * CALLS_PER_PAGE
     if request.headers.get("Accept") == "application/json":
-        return jsonify({"calls": calls[start:end]})
-    return render_template("scanner_fire.html", calls=calls[:CALLS_PER_PAGE])
+        calls = load_calls(f"{ARCHIVE_DIR}/fd", feed="fd", filter_today=True, limit=CALLS_PER_PAGE, offset=start)
+        return jsonify({"calls": calls})
+    last_seq = call_index.max_seq()
+    calls = load_calls(f"{ARCHIVE_DIR}/fd", feed="fd", filter_today=True, limit=CALLS_PER_PAGE)
+    return render_template("scanner_fire.html", calls=calls, last_seq=last_seq)
 
 
 # Backwards-compatible aliases: some links use /scanner_fd — keep working
@@ -177,13 +172,13 @@ def scanner_fd():
 
 @scanner_bp.route("/scanner")
 def scanner_list():
-    calls = load_calls(f"{ARCHIVE_DIR}/pd", filter_today=True)
     page = int(request.args.get("page", 1))
-    start = (page - 1) * CALLS_PER_PAGE
-    end = start + CALLS_PER_PAGE
+    start = max(page - 1, 0) * CALLS_PER_PAGE
     if request.headers.get("Accept") == "application/json" or request.args.get("json") == "1":
-        return jsonify({"calls": calls[start:end]})
-    return render_template("scanner.html", calls=calls[:CALLS_PER_PAGE])
+        calls = load_calls(f"{ARCHIVE_DIR}/pd", filter_today=True, limit=CALLS_PER_PAGE, offset=start)
+        return jsonify({"calls": calls})
+    calls = load_calls(f"{ARCHIVE_DIR}/pd", filter_today=True, limit=CALLS_PER_PAGE)
+    return render_template("scanner.html", calls=calls)
 
 
 # Accept trailing slash as well so `/scanner/` doesn't 404.
@@ -192,74 +187,96 @@ def scanner_list_slash():
     return scanner_list()
 
 
-@scanner_bp.route("/scanner/archive")
-def scanner_archive():
-    sorted_archive = load_archive(f"{ARCHIVE_DIR}/pd")
+@scanner_bp.route("/scanner/stream")
+def scanner_stream():
+    """Server-Sent Events stream of new calls, one `call` event per call with
+    its seq as the event id. Reconnecting clients send Last-Event-ID (or
+    ?last_id=) and get the calls they missed before live ones."""
+    feeds = list(call_index.FEEDS)
+    if request.args.get("feed"):
+        if request.args["feed"] not in feeds:
+            return jsonify({"error": "Invalid feed"}), 400
+        feeds = [request.args["feed"]]
+    try:
+        last_id = request.headers.get("Last-Event-ID") or request.args.get("last_id")
+        last_id = int(last_id) if last_id else None
+    except ValueError:
+        return jsonify({"error": "Invalid Last-Event-ID"}), 400
+
+    listener, head = CALL_STREAM.subscribe()
+    # Subscribe before reading the backlog so nothing falls between the two;
+    # anything seen twice is skipped by seq.
+    backlog = CALL_STREAM.backlog(last_id, feeds) if last_id is not None else []
+    sent = last_id if last_id is not None else head
+
+    def events():
+        nonlocal sent
+        try:
+            yield "retry: 3000\n\n"
+            pending = list(backlog)
+            while True:
+                for event in pending:
+                    if event is None:
+                        return
+                    seq, feed, record = event
+                    if seq <= sent or feed not in feeds:
+                        continue
+                    sent = seq
+                    yield f"id: {seq}\nevent: call\ndata: {json.dumps(record)}\n\n"
+                try:
+                    pending = [listener.get(timeout=STREAM_KEEPALIVE)]
+                except queue.Empty:
+                    pending = []
+                    yield ": keepalive\n\n"
+        finally:
+            CALL_STREAM.unsubscribe(listener)
+
+    return Response(events(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+def _archive_response(directory, archive_url):
     if request.headers.get("Accept") == "application/json" or request.args.get("json") == "1":
         day = request.args.get("day")
         page = int(request.args.get("page", 1))
-        if day and day in sorted_archive:
-            calls = sorted_archive[day]
-            start = (page - 1) * CALLS_PER_PAGE
-            end = start + CALLS_PER_PAGE
-            return jsonify({"calls": calls[start:end], "total": len(calls)})
+        feed = Path(directory).name
+        call_index.refresh(feed, directory)
+        total = call_index.day_count(feed, day) if day else 0
+        if total:
+            return jsonify({"calls": load_archive_page(directory, day, page), "total": total})
         return jsonify({"error": "Invalid day"}), 400
 
-    archive_render = {}
-    call_totals = {}
-    for day, call_list in sorted_archive.items():
-        call_totals[day] = len(call_list)
-        archive_render[day] = call_list[:CALLS_PER_PAGE]
-
+    # Only day keys and counts are rendered up front; each day's calls are
+    # fetched page by page when it is expanded.
+    call_totals = load_archive_days(directory)
     return render_template(
         "scanner_archive.html",
-        archive=archive_render,
+        archive={day: [] for day in call_totals},
         calls_per_page=CALLS_PER_PAGE,
-        call_totals=call_totals
+        call_totals=call_totals,
+        archive_url=archive_url
     )
 
 
-@scanner_bp.route("/scanner_fire/archive")
-def scanner_fire_archive():
-    sorted_archive = load_archive(f"{ARCHIVE_DIR}/fd")
-    if request.headers.get("Accept") == "application/json" or request.args.get("json") == "1":
-        day = request.args.get("day")
-        page = int(request.args.get("page", 1))
-        if day and day in sorted_archive:
-            calls = sorted_archive[day]
-            start = (page - 1) * CALLS_PER_PAGE
-            end = start + CALLS_PER_PAGE
-            return jsonify({"calls": calls[start:end], "total": len(calls)})
-        return jsonify({"error": "Invalid day"}), 400
+@scanner_bp.route("/scanner/archive")
+def scanner_archive():
+    return _archive_response(f"{ARCHIVE_DIR}/pd", "/scanner/archive")
 
-    archive_render = {}
-    call_totals = {}
-    for day, call_list in sorted_archive.items():
-        call_totals[day] = len(call_list)
-        archive_render[day] = call_list[:CALLS_PER_PAGE]
 
-    return render_template(
-        "scanner_archive.html",
-        archive=archive_render,
-        calls_per_page=CALLS_PER_PAGE,
-        call_totals=call_totals
-    )
+@scanner_bp.route("/scanner_fire/archive")
+def scanner_fire_archive():
+    return _archive_response(f"{ARCHIVE_DIR}/fd", "/scanner_fire/archive")
 
 
 @scanner_bp.route("/scanner/audio/<filename>")
 def scanner_audio(filename):
-    search_paths = [
-        Path("/home/ned/scanner_archive/clean/pd"),
-        Path("/home/ned/scanner_archive/clean/fd"),
-        Path("/home/ned/scanner_archive/segmentation/processed")
-    ]
-
-    for path in search_paths:
-        file_path = path / filename
-        if file_path.exists():
-            return send_from_directory(path, filename)
-
-    return "File not found", 404
+    path = audio_files.find_audio(filename, call_index.ALL_FEEDS)
+    if path is None:
+        return "File not found", 404
+    try:
+        return audio_files.send_call_audio(path)
+    except FileNotFoundError:
+        return "File not found", 404
 
 
 @scanner_bp.route("/scanner/submit_edit", methods=["POST"])
@@ -278,29 +295,97 @@ def submit_edit():
 
     new_transcript = data.get("transcript", "").strip()
     feed = data.get("feed", "pd")
+    if feed not in call_index.FEEDS:
+        return jsonify({"success": False, "error": "Invalid feed"}), 400
 
-    src_dir = Path(f"/home/ned/scanner_archive/clean/{feed}")
-    src_wav = src_dir / filename
+    src_wav = call_index.feed_dir(feed) / filename
     src_json = src_wav.with_suffix(".json")
 
     if not src_wav.exists() or not src_json.exists():
         return jsonify({"success": False, "error": "Source file missing"}), 404
 
     try:
-        REVIEW_DIR.mkdir(parents=True, exist_ok=True)
-        dst_wav = REVIEW_DIR / src_wav.name
-        shutil.copy2(src_wav, dst_wav)
-        with open(src_json) as f:
-            meta = json.load(f)
-        meta["edited_transcript"] = new_transcript
-        dst_json = REVIEW_DIR / src_json.name
-        with open(dst_json, "w") as f:
-            json.dump(meta, f, indent=2)
-        return jsonify({"success": True})
+        # queue the edit against the archived call; the audio stays put
+        meta = meta_cache.load_json(src_json)
+        original = meta.get("edited_transcript") if meta.get("edited") else meta.get("transcript")
+        edit_id = review_db.submit(feed, filename, new_transcript, original,
+                                   submitted_by=request.remote_addr, wav_path=str(src_wav))
+        call_index.refresh_edit_pending([(feed, filename)])
+        return jsonify({"success": True, "edit_id": edit_id})
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
 
+@scanner_bp.route("/scanner/review")
+def review_queue():
+    """Edits awaiting (or past) moderation, newest first.
+
+    Query: status (default pending), feed, limit, and before=<id> for the
+    next page.
+    """
+    status = request.args.get("status", "pending")
+    if status not in review_db.STATUSES:
+        return jsonify({"error": "unknown status"}), 400
+    edits = review_db.list_edits(status, request.args.get("feed"),
+                                 limit=int(request.args.get("limit", 50)),
+                                 before=request.args.get("before", type=int))
+    return jsonify({"edits": edits, "counts": review_db.counts(),
+                    "next_before": edits[-1]["id"] if edits else None})
+
+
+@scanner_bp.route("/scanner/review/<int:edit_id>/<action>", methods=["POST"])
+def review_decide(edit_id, action):
+    """Approve or reject one pending edit. Body: {reviewer, note}."""
+    status = {"approve": "approved", "reject": "rejected"}.get(action)
+    if status is None:
+        return jsonify({"success": False, "error": "unknown action"}), 404
+    data = request.get_json(silent=True) or {}
+    edit = review_db.get_edit(edit_id)
+    if edit is None:
+        return jsonify({"success": False, "error": "unknown edit"}), 404
+    if not review_db.set_status([edit_id], status, data.get("reviewer"), data.get("note")):
+        return jsonify({"success": False, "error": f"edit is {edit['status']}"}), 409
+    call_index.refresh_edit_pending([(edit["feed"], edit["filename"])])
+    result = review_apply.apply_approved([edit_id]) if status == "approved" else None
+    return jsonify({"success": True, "edit": review_db.get_edit(edit_id), "apply": result})
+
+
+@scanner_bp.route("/scanner/review/approve", methods=["POST"])
+def review_approve_batch():
+    """Approve many pending edits and write them to the archive as one batch.
+
+    Body: {"ids": [...], "reviewer": ..., "note": ...}. Ids that are no longer
+    pending are skipped (and reported).
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        ids = [int(i) for i in data.get("ids") or []]
+    except (TypeError, ValueError):
+        ids = None
+    if ids is None or len(ids) > review_apply.BATCH_MAX:
+        return jsonify({"success": False, "error": f"ids must be a list of at most {review_apply.BATCH_MAX}"}), 400
+    approved = review_db.set_status(ids, "approved", data.get("reviewer"), data.get("note"))
+    call_index.refresh_edit_pending(review_db.edit_calls(approved))
+    result = review_apply.apply_approved(approved)
+    return jsonify({"success": not result["failed"], "approved": approved,
+                    "skipped": [i for i in ids if i not in approved], **result})
+
+
+@scanner_bp.route("/scanner/review/apply", methods=["POST"])
+def review_apply_pending():
+    """Apply approved edits that have not reached the archive yet (e.g. after
+    a failed write). Body: {"feed": ..., "limit": ...}."""
+    data = request.get_json(silent=True) or {}
+    try:
+        limit = int(data.get("limit", review_apply.BATCH_MAX))
+    except (TypeError, ValueError):
+        limit = 0
+    if limit < 1:
+        return jsonify({"success": False, "error": "limit must be a positive integer"}), 400
+    result = review_apply.apply_approved(feed=data.get("feed"), limit=limit)
+    return jsonify({"success": not result["failed"], **result})
+
+
 @scanner_bp.route('/scanner/_heartbeat', methods=['POST'])
 def scanner_heartbeat():
     """Receive periodic heartbeats from clients to mark them active."""
@@ -308,14 +393,11 @@ def scanner_heartbeat():
     client_id = data.get('client_id') or str(uuid.uuid4())
     page = data.get('page', '')
     ua = request.headers.get('User-Agent', '')
-    now = time.time()
-    with ACTIVE_LOCK:
-        ACTIVE_USERS[client_id] = {
-            'last_seen': now,
-            'ip': request.remote_addr,
-            'ua': ua,
-            'page': page,
-        }
+    try:
+        presence.heartbeat(client_id, request.remote_addr, ua, page)
+    except redis.RedisError as e:
+        print('heartbeat error', e)
+        return jsonify({'success': False, 'client_id': client_id}), 503
     return jsonify({'success': True, 'client_id': client_id})
 
 
@@ -334,85 +416,149 @@ def scanner_login():
 
 @scanner_bp.route('/scanner/admin/active')
 def scanner_active():
-    """Return currently active clients seen within ACTIVE_TIMEOUT seconds."""
-    cutoff = time.time() - ACTIVE_TIMEOUT
-    with ACTIVE_LOCK:
-        # remove stale entries to keep memory small
-        stale = [k for k, v in ACTIVE_USERS.items() if v['last_seen'] < cutoff]
-        for k in stale:
-            del ACTIVE_USERS[k]
-        active = [
-            {
-                'client_id': k,
-                'ip': v['ip'],
-                'ua': v['ua'],
-                'page': v.get('page', ''),
-                'last_seen': v['last_seen']
-            }
-            for k, v in ACTIVE_USERS.items()
-        ]
-    return jsonify({'active_count': len(active), 'active': active})
+    """Return currently active clients seen within ACTIVE_TIMEOUT seconds,
+    across every web process (most recent first, at most ?limit)."""
+    limit = min(int(request.args.get('limit', 500)), 5000)
+    count, active = presence.active_clients(limit)
+    return jsonify({'active_count': count, 'active': active})
+
+
+@scanner_bp.route('/scanner/admin/stats')
+def scanner_listener_stats():
+    """Unique and peak concurrent listeners per hour and per day (overall and
+    per page) for the last ?hours hours and ?days days."""
+    hours = max(min(int(request.args.get('hours', 24)), 24 * 7), 0)
+    days = max(min(int(request.args.get('days', 7)), 400), 0)
+    return jsonify(presence.listener_stats(hours, days))
+
+
+@scanner_bp.route('/scanner/admin/cache')
+def scanner_cache_stats():
+    """Hit/miss counters for the shared call metadata cache."""
+    return jsonify(meta_cache.stats())
 
 
 @scanner_bp.route("/api/pd_heatmap")
 def pd_heatmap():
-    now = datetime.datetime.now()
-    start = now - datetime.timedelta(days=6)
-    heatmap = defaultdict(lambda: [0] * 24)
+    """Calls per day and hour, read from the index's hour rollups.
 
-    for file in PD_DIR.glob("*.json"):
-        try:
-            with open(file) as f:
-                meta = json.load(f)
-            ts = meta.get("timestamp")
-            if not ts:
-                continue
-            dt = datetime.datetime.fromisoformat(ts)
-            if dt < start:
-                continue
-            date_key = dt.strftime("%Y-%m-%d")
-            heatmap[date_key][dt.hour] += 1
-        except Exception:
-            continue
+    Query args: `feed` (pd/fd, default pd) and an inclusive `from` / `to`
+    range of YYYY-MM-DD days (default the last 7 days). Only days with calls
+    are listed.
+    """
+    feed = request.args.get("feed", "pd")
+    if feed not in call_index.FEEDS:
+        return jsonify({"error": "Invalid feed"}), 400
+    today = datetime.date.today()
+    try:
+        first = datetime.date.fromisoformat(request.args.get("from") or (today - datetime.timedelta(days=6)).isoformat())
+        last = datetime.date.fromisoformat(request.args.get("to") or today.isoformat())
+    except ValueError:
+        return jsonify({"error": "Invalid date, use YYYY-MM-DD"}), 400
+    if first > last:
+        return jsonify({"error": "from must not be after to"}), 400
+
+    call_index.refresh(feed)
+    heatmap = defaultdict(lambda: [0] * 24)
+    for day, hour, count in call_index.hour_counts(feed, first.isoformat(), last.isoformat()):
+        heatmap[day][hour] = count
 
     sorted_days = sorted(heatmap.keys())
     matrix = [heatmap[day] for day in sorted_days]
 
     return jsonify({"days": sorted_days, "data": matrix})
 
-@scanner_bp.route("/scanner/submit_segment_label", methods=["POST"])
-def submit_segment_label():
-    data = request.get_json()
-    if not data:
-        return jsonify({"success": False, "error": "Invalid JSON"}), 400
+class LabelError(Exception):
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
 
-    filename = data.get("filename")
-    speaker = data.get("speaker")
-    label = data.get("label", "").strip()
+
+def _segment_label_update(item):
+    """(sidecar path, update fn) for one {filename, speaker, label} request.
+    Raises LabelError with the response's message and status."""
+    filename = item.get("filename")
+    speaker = item.get("speaker")
+    label = (item.get("label") or "").strip()
 
     if not filename or not speaker:
-        return jsonify({"success": False, "error": "Missing required fields"}), 400
+        raise LabelError("Missing required fields", 400)
 
-    json_path = SEGMENT_DIR / filename
+    json_path = SEGMENT_DIR / Path(filename).name
     if json_path.suffix != ".wav":
-        return jsonify({"success": False, "error": "Invalid file type"}), 400
+        raise LabelError("Invalid file type", 400)
 
     json_file = json_path.with_suffix(".json")
     if not json_file.exists():
-        return jsonify({"success": False, "error": "Metadata JSON not found"}), 404
-
-    try:
-        with open(json_file) as f:
-            meta = json.load(f)
+        raise LabelError("Metadata JSON not found", 404)
 
+    def update(meta):
         meta["speaker_role"] = speaker  # e.g., "dispatcher" or "officer"
         if label:
             meta["speaker_label"] = label  # e.g., "303", "Control", etc.
+        return meta
+    return json_file, update
+
+
+@scanner_bp.route("/scanner/submit_segment_label", methods=["POST"])
+def submit_segment_label():
+    data = request.get_json()
+    if not data:
+        return jsonify({"success": False, "error": "Invalid JSON"}), 400
 
-        with open(json_file, "w") as f:
-            json.dump(meta, f, indent=2)
+    try:
+        json_file, update = _segment_label_update(data)
+    except LabelError as e:
+        return jsonify({"success": False, "error": str(e)}), e.status
 
+    try:
+        meta_store.update_json(json_file, update)
+        call_index.index_call(call_index.SEGMENT_FEED, json_file.stem)
         return jsonify({"success": True})
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
+
+@scanner_bp.route("/scanner/submit_segment_labels", methods=["POST"])
+def submit_segment_labels():
+    """Apply many segment labels in one request.
+
+    Body: {"labels": [{"filename", "speaker", "label"}, ...]}. Valid labels
+    are written together (one locked, atomic, fsynced batch; several labels
+    for one segment apply in order); invalid ones, and those whose segment
+    couldn't be written, are reported by index.
+    """
+    data = request.get_json(silent=True) or {}
+    labels = data.get("labels")
+    if not isinstance(labels, list) or not labels:
+        return jsonify({"success": False, "error": "labels must be a non-empty list"}), 400
+    if len(labels) > SEGMENT_LABELS_MAX:
+        return jsonify({"success": False, "error": f"at most {SEGMENT_LABELS_MAX} labels per request"}), 400
+
+    updates, errors = [], []
+    for i, item in enumerate(labels):
+        try:
+            updates.append((i, *_segment_label_update(item if isinstance(item, dict) else {})))
+        except LabelError as e:
+            errors.append({"index": i, "error": str(e)})
+
+    try:
+        written = meta_store.update_many([(path, update) for _, path, update in updates])
+        applied = len(updates)
+    except Exception:
+        # one unreadable sidecar fails the whole batch; write segment by
+        # segment instead and report the labels of the ones that fail
+        by_path = {}
+        for i, path, update in updates:
+            by_path.setdefault(path, []).append((i, update))
+        written, applied = {}, 0
+        for path, items in by_path.items():
+            try:
+                written.update(meta_store.update_many([(path, update) for _, update in items]))
+                applied += len(items)
+            except Exception as e:
+                errors.extend({"index": i, "error": str(e)} for i, _ in items)
+        errors.sort(key=lambda e: e["index"])
+    if written:
+        call_index.index_calls((call_index.SEGMENT_FEED, path.stem) for path in written)
+    return jsonify({"success": not errors, "applied": applied, "segments": len(written), "errors": errors})
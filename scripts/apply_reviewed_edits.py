@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+"""Write approved transcript edits that are not in the archive yet back into
+the clean archive's JSON sidecars, in batches.
+
+Usage:
+    python3 scripts/apply_reviewed_edits.py            # every approved edit
+    python3 scripts/apply_reviewed_edits.py --feed pd --batch 100
+"""
+import argparse
+import os
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, ROOT)
+
+import call_index
+import review_apply
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    p.add_argument('--feed', choices=call_index.FEEDS, help='only this feed (default: all)')
+    p.add_argument('--batch', type=int, default=review_apply.BATCH_MAX, help='edits per batch')
+    args = p.parse_args()
+    t0 = time.time()
+    applied, failed = 0, {}
+    while True:
+        result = review_apply.apply_approved(feed=args.feed, limit=args.batch)
+        applied += len(result['applied'])
+        for f in result['failed']:
+            failed[f['id']] = f['error']
+        # failed edits stay unapplied, so stop once a batch makes no progress
+        if not result['applied']:
+            break
+    for edit_id, error in sorted(failed.items()):
+        print(f'edit {edit_id}: {error}')
+    print(f'applied {applied} edits, {len(failed)} failed, in {time.time() - t0:.1f}s')
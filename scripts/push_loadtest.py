@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""Load-test push fan-out against a local stand-in push service.
+
+Usage:
+    python3 scripts/push_loadtest.py --subs 2000 --jobs 5 --latency 40 --gone-rate 0.01 --throttle-rate 0.02
+
+Creates N synthetic subscriptions (real P-256 p256dh keys and auth secrets,
+so payloads are encrypted exactly as in production) in a scratch push_db,
+starts one stand-in push service per --origins on localhost in a separate
+process, queues --jobs broadcasts on push_queue and runs --workers push
+worker threads until every job is done. Reports messages per second, p50/p99
+send latency (from the push_jobs latency buckets) and worker CPU per message.
+
+Nothing touches real push services or the real subscription database. Use a
+Redis database that no live push worker reads from (--redis-url, default
+db 15); its push keys are cleared first.
+"""
+import argparse
+import base64
+import json
+import multiprocessing
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, ROOT)
+
+import redis
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from py_vapid import Vapid02
+
+import push_coalesce
+import push_db
+import push_jobs
+import push_worker
+
+# Distinct subscriber keys generated; subscriptions beyond this reuse them.
+KEY_POOL = 256
+
+
+def _b64(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def synthetic_subscriptions(n, base_urls):
+    keys = []
+    for _ in range(min(n, KEY_POOL)):
+        pub = ec.generate_private_key(ec.SECP256R1()).public_key()
+        point = pub.public_bytes(serialization.Encoding.X962, serialization.PublicFormat.UncompressedPoint)
+        keys.append(_b64(point))
+    return [{'endpoint': f"{base_urls[i % len(base_urls)]}/push/{i}",
+             'keys': {'p256dh': keys[i % len(keys)], 'auth': _b64(os.urandom(16))}}
+            for i in range(n)]
+
+
+def serve_push(port, latency_ms, jitter_ms, gone_rate, throttle_rate):
+    """Stand-in push service: waits latency +/- jitter, then answers 410,
+    429 (Retry-After: 1) or 201 at the given rates."""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            time.sleep(max(latency_ms + random.uniform(-jitter_ms, jitter_ms), 0) / 1000)
+            roll = random.random()
+            if roll < gone_rate:
+                self._reply(410)
+            elif roll < gone_rate + throttle_rate:
+                self._reply(429, {'Retry-After': '1'})
+            else:
+                self._reply(201)
+
+        def _reply(self, status, headers=None):
+            self.send_response(status)
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    server.daemon_threads = True
+    server.serve_forever()
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _clear_push_keys(r):
+    for pattern in ('push_queue', 'push_processing:*', 'push_worker:*', 'push_dead', 'push_job_stats',
+                    'push_job:*', 'push_coalesce*'):
+        for key in r.scan_iter(match=pattern):
+            r.delete(key)
+
+
+def _pct(histograms):
+    merged = {}
+    for h in histograms:
+        for bucket, n in h.items():
+            merged[bucket] = merged.get(bucket, 0) + n
+    return push_jobs.percentiles(merged)
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    p.add_argument('--subs', type=int, default=1000, help='synthetic subscriptions')
+    p.add_argument('--jobs', type=int, default=3, help='broadcasts to queue')
+    p.add_argument('--workers', type=int, default=1, help='push worker threads')
+    p.add_argument('--origins', type=int, default=2, help='stand-in push services (one origin each)')
+    p.add_argument('--latency', type=float, default=50, help='push service latency in ms')
+    p.add_argument('--jitter', type=float, default=20, help='latency jitter in ms')
+    p.add_argument('--gone-rate', type=float, default=0.0, help='fraction answered 410')
+    p.add_argument('--throttle-rate', type=float, default=0.0, help='fraction answered 429')
+    p.add_argument('--redis-url', default='redis://127.0.0.1:6379/15')
+    args = p.parse_args()
+
+    push_db.DB_PATH = os.path.join(tempfile.mkdtemp(prefix='push_loadtest'), 'push_subs.sqlite3')
+    push_db.RATE_CAP = 0  # every job should reach every subscription
+    r = redis.from_url(args.redis_url)
+    _clear_push_keys(r)
+
+    ports = [_free_port() for _ in range(args.origins)]
+    servers = [multiprocessing.Process(target=serve_push, daemon=True,
+                                       args=(port, args.latency, args.jitter, args.gone_rate, args.throttle_rate))
+               for port in ports]
+    for s in servers:
+        s.start()
+
+    t0 = time.time()
+    push_db.save_subscriptions(synthetic_subscriptions(args.subs, [f"http://127.0.0.1:{port}" for port in ports]))
+    print(f'{args.subs} subscriptions in {time.time() - t0:.1f}s ({push_db.DB_PATH})')
+
+    signer = Vapid02()
+    signer.generate_keys()
+
+    job_ids = []
+    for i in range(args.jobs):
+        job = {'message': f'load test {i}', 'topic': push_db.job_topic(None, f'load test {i}')}
+        job_ids.append(push_jobs.create(r, job))
+        push_coalesce.enqueue(r, job, window=0)
+
+    stop = threading.Event()
+    cpu0, t0 = time.process_time(), time.time()
+    threads = [threading.Thread(target=push_worker.run_worker,
+                                kwargs={'stop': stop, 'r': r, 'wid': f'loadtest-{i}', 'vapid_key': signer})
+               for i in range(args.workers)]
+    for t in threads:
+        t.start()
+    while True:
+        jobs = [push_jobs.get(r, job_id) for job_id in job_ids]
+        if all(j['status'] in ('done', 'failed') for j in jobs):
+            break
+        time.sleep(0.2)
+    elapsed, cpu = time.time() - t0, time.process_time() - cpu0
+    stop.set()
+    for t in threads:
+        t.join()
+    for s in servers:
+        s.terminate()
+
+    messages = sum(j['total'] for j in jobs)
+    histograms = [{k.decode(): int(v) for k, v in r.hgetall(push_jobs.JOB_PREFIX + j + ':latency').items()}
+                  for j in job_ids]
+    report = {
+        'jobs': len(jobs),
+        'messages': messages,
+        'sent': sum(j['sent'] for j in jobs),
+        'removed': sum(j['removed'] for j in jobs),
+        'backoff': sum(j['backoff'] for j in jobs),
+        'elapsed_s': round(elapsed, 2),
+        'messages_per_s': round(messages / elapsed, 1) if elapsed else None,
+        'latency_ms': _pct(histograms),
+        'cpu_ms_per_message': round(cpu * 1000 / messages, 3) if messages else None,
+    }
+    print(json.dumps(report, indent=2))
+    _clear_push_keys(r)
@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+"""Recreate the call index from the archive directory tree.
+
+Usage:
+    python3 scripts/rebuild_call_index.py            # all feeds
+    python3 scripts/rebuild_call_index.py --feed pd
+
+Safe to run while the web app is up; readers keep using the old rows until
+each feed's rebuild commits.
+"""
+import argparse
+import os
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, ROOT)
+
+import call_index
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    p.add_argument('--feed', action='append', choices=call_index.ALL_FEEDS, help='feed to rebuild (default: all)')
+    args = p.parse_args()
+    t0 = time.time()
+    totals = call_index.rebuild(args.feed or call_index.ALL_FEEDS)
+    for feed, n in totals.items():
+        print(f'{feed}: indexed {n} calls')
+    print(f'done in {time.time() - t0:.1f}s ({call_index.DB_PATH})')
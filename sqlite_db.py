@@ -0,0 +1,37 @@
+import sqlite3
+import threading
+
+# Connection handling shared by the SQLite stores (call_index, push_db,
+# review_db): one long-lived connection per thread in WAL mode, so readers
+# never wait on a writer, and the schema set up once per process by the first
+# connection.
+
+
+class ThreadLocalDB:
+    def __init__(self, path, setup, row_factory=None):
+        """path() returns the database file (read at connect time, so callers
+        may repoint it); setup(conn) creates or upgrades the schema and
+        commits."""
+        self.path = path
+        self.setup = setup
+        self.row_factory = row_factory
+        self._local = threading.local()
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+
+    def conn(self):
+        """Return this thread's connection, creating it on first use."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path(), timeout=30)
+            if self.row_factory is not None:
+                conn.row_factory = self.row_factory
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        if not self._schema_ready:
+            with self._schema_lock:
+                if not self._schema_ready:
+                    self.setup(conn)
+                    self._schema_ready = True
+        return conn
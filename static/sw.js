@@ -97,6 +97,11 @@ self.addEventListener('push', function(event) {
     badge: 'static/icons/icon-192.png',
     data: payload.data || {}
   };
+  // digests of a call burst share a tag, so a newer one replaces the last
+  if (payload.tag) {
+    options.tag = payload.tag;
+    options.renotify = true;
+  }
 
   event.waitUntil(self.registration.showNotification(title, options));
 });
@@ -0,0 +1,173 @@
+import os
+import queue
+import shutil
+import subprocess
+import threading
+import time
+from pathlib import Path
+
+import call_index
+
+# Compressed variants of the archived WAVs for listeners on slow connections.
+# Each variant is encoded once with ffmpeg into CACHE_DIR and reused; the
+# directory is kept under MAX_BYTES by evicting the least recently served
+# files. A hit bumps the file's atime only: the mtime stays put, so the
+# variant's validators never change between plays.
+CACHE_DIR = Path(os.environ.get('AUDIO_CACHE_DIR', os.path.join(os.path.dirname(__file__), 'audio_cache')))
+MAX_BYTES = int(os.environ.get('AUDIO_CACHE_MAX_BYTES', str(2 * 1024 ** 3)))
+FFMPEG = os.environ.get('FFMPEG', 'ffmpeg')
+# Formats to encode as soon as a call lands, e.g. "opus,mp3"; empty disables.
+PRETRANSCODE_FORMATS = tuple(f for f in os.environ.get('AUDIO_PRETRANSCODE', '').split(',') if f)
+
+# format -> (file extension, mimetype, ffmpeg output args). Scanner audio is
+# mono speech, so low bitrates are plenty.
+FORMATS = {
+    'opus': ('opus', 'audio/ogg', ['-c:a', 'libopus', '-b:a', '24k', '-application', 'voip', '-f', 'ogg']),
+    'mp3': ('mp3', 'audio/mpeg', ['-c:a', 'libmp3lame', '-b:a', '48k', '-f', 'mp3']),
+}
+ENCODE_TIMEOUT = 120
+
+_key_locks = {}
+_key_locks_lock = threading.Lock()
+_evict_lock = threading.Lock()
+_queue = queue.Queue()
+_worker = None
+_worker_lock = threading.Lock()
+_available = None
+
+
+class TranscodeError(Exception):
+    pass
+
+
+def available():
+    """Whether ffmpeg is installed; looked up once per process."""
+    global _available
+    if _available is None:
+        _available = shutil.which(FFMPEG) is not None
+        if not _available:
+            print('transcode_cache: ffmpeg not found, serving WAV only:', FFMPEG)
+    return _available
+
+
+def mimetype(fmt):
+    return FORMATS[fmt][1]
+
+
+def variant_path(src, fmt):
+    """Where the fmt variant of src lives in the cache. The name includes the
+    source's mtime and size, so a replaced recording never reuses a stale
+    variant."""
+    src = Path(src)
+    st = src.stat()
+    ext = FORMATS[fmt][0]
+    return CACHE_DIR / f"{src.parent.name}-{src.stem}-{st.st_mtime_ns:x}-{st.st_size:x}.{ext}"
+
+
+def _lock_for(key):
+    with _key_locks_lock:
+        return _key_locks.setdefault(key, threading.Lock())
+
+
+def get_variant(src, fmt):
+    """Return the path of the cached fmt variant of src, encoding it first if
+    needed. Raises TranscodeError if ffmpeg fails or is missing."""
+    if fmt not in FORMATS:
+        raise ValueError(f"unknown format {fmt!r}")
+    dst = variant_path(src, fmt)
+    if _touch(dst):
+        return dst
+    lock = _lock_for(str(dst))
+    with lock:
+        if _touch(dst):
+            return dst
+        _encode(src, dst, fmt)
+    with _key_locks_lock:
+        _key_locks.pop(str(dst), None)
+    evict()
+    return dst
+
+
+def _touch(path):
+    """Mark path as just served (atime = now, mtime unchanged)."""
+    try:
+        st = os.stat(path)
+        os.utime(path, ns=(time.time_ns(), st.st_mtime_ns))
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def _encode(src, dst, fmt):
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = dst.with_name(f".{dst.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    cmd = [FFMPEG, '-nostdin', '-loglevel', 'error', '-y', '-i', str(src), '-ac', '1',
+           *FORMATS[fmt][2], str(tmp)]
+    try:
+        proc = subprocess.run(cmd, capture_output=True, timeout=ENCODE_TIMEOUT)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        tmp.unlink(missing_ok=True)
+        raise TranscodeError(str(e)) from e
+    if proc.returncode != 0:
+        tmp.unlink(missing_ok=True)
+        raise TranscodeError(proc.stderr.decode(errors='replace').strip() or f"ffmpeg exited {proc.returncode}")
+    os.replace(tmp, dst)
+
+
+def evict(max_bytes=None):
+    """Delete least recently used variants until the cache fits max_bytes."""
+    max_bytes = MAX_BYTES if max_bytes is None else max_bytes
+    with _evict_lock:
+        entries = []
+        total = 0
+        try:
+            with os.scandir(CACHE_DIR) as it:
+                for entry in it:
+                    if entry.name.startswith('.') or not entry.is_file():
+                        continue
+                    st = entry.stat()
+                    entries.append((st.st_atime, st.st_size, entry.path))
+                    total += st.st_size
+        except FileNotFoundError:
+            return 0
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total <= max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        return removed
+
+
+def pretranscode(changes):
+    """archive_watcher listener: queue the configured variants of newly
+    indexed calls for encoding in the background."""
+    for feed, stem in changes:
+        if feed in call_index.FEEDS:
+            _queue.put((feed, stem))
+    if changes:
+        _start_worker()
+
+
+def _start_worker():
+    global _worker
+    with _worker_lock:
+        if _worker is None:
+            _worker = threading.Thread(target=_work, name='pretranscode', daemon=True)
+            _worker.start()
+
+
+def _work():
+    while True:
+        feed, stem = _queue.get()
+        src = call_index.feed_dir(feed) / f"{stem}.wav"
+        for fmt in PRETRANSCODE_FORMATS:
+            try:
+                if src.exists():
+                    get_variant(src, fmt)
+            except Exception as e:
+                print('pretranscode error', src.name, fmt, e)